@@ -1,10 +1,21 @@
 import base64
+import hashlib
+import itertools
+import math
 import os
-from cryptography.hazmat.primitives import hashes, padding, ciphers
+from cryptography.hazmat.primitives import hashes, padding, ciphers, cmac
 import struct
+import tempfile
+import threading
 import time
+import weakref
+import zlib
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
 
+from cryptography.exceptions import InvalidTag
 from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 
 
 class InvalidToken(Exception):
@@ -14,7 +25,7 @@ class InvalidToken(Exception):
 def num(byte_it):
   """Convert bytes array to a number(note endian-ness!)"""
   num = 0x00
-  for i, b in enumerate(bytearray(byte_it[::-1])):
+  for i, b in enumerate(bytearray(byte_it)[::-1]):
     num = num | (b << 8 * i)
 
   return num
@@ -34,6 +45,176 @@ def split_into_blocks(msg, l):
     msg = msg[l:]
 
 
+class Base64Encoder(object):
+  """
+  Incremental base64url encoding. `update` returns the encoding of the whole
+  3 byte groups seen so far and holds back the rest, `finalize` encodes
+  (and pads) what is left. Together they return exactly
+  `base64.urlsafe_b64encode` of everything passed to `update`, so a token
+  can be written out while it is being produced.
+  """
+
+  def __init__(self):
+    self._pending = b""
+
+  def update(self, data):
+    data = memoryview(data)
+    head = b""
+
+    # Complete the pending group first, so `data` itself is not copied.
+    if self._pending:
+      n = 3 - len(self._pending)
+      self._pending += data[:n].tobytes()
+      data = data[n:]
+
+      if len(self._pending) < 3:
+        return b""
+
+      head = base64.urlsafe_b64encode(self._pending)
+
+    n = len(data) // 3 * 3
+    self._pending = data[n:].tobytes()
+
+    return head + base64.urlsafe_b64encode(data[:n])
+
+  def finalize(self):
+    pending, self._pending = self._pending, b""
+
+    return base64.urlsafe_b64encode(pending)
+
+
+class Base64Decoder(object):
+  """
+  Incremental base64url decoding, the inverse of `Base64Encoder`. `update`
+  decodes the whole 4 character groups seen so far, `finalize` the rest
+  (which is only valid if it is empty or a padded group).
+  """
+
+  def __init__(self):
+    self._pending = b""
+
+  def update(self, text):
+    if self._pending:
+      text = self._pending + text
+
+    n = len(text) // 4 * 4
+    self._pending = text[n:]
+
+    return base64.urlsafe_b64decode(text[:n])
+
+  def finalize(self):
+    pending, self._pending = self._pending, b""
+
+    return base64.urlsafe_b64decode(pending)
+
+
+def _urlsafe_b64encode_parts(*parts):
+  """
+  `base64.urlsafe_b64encode` of the concatenation of `parts`, encoded one
+  part at a time so the raw concatenation is never built.
+  """
+  encoder = Base64Encoder()
+  encoded = [encoder.update(part) for part in parts]
+  encoded.append(encoder.finalize())
+
+  return b"".join(encoded)
+
+
+def _urlsafe_b64decode_chunks(reader, chunk_size):
+  """
+  Read base64url text from `reader` and yield the decoded bytes, decoding
+  only whole 4 character groups at a time.
+  """
+  decoder = Base64Decoder()
+  while True:
+    text = reader.read(chunk_size)
+    if not text:
+      break
+
+    yield decoder.update(text)
+
+  yield decoder.finalize()
+
+
+def _urlsafe_b64decode_slice(token, start, stop):
+  """
+  Decode only bytes [start, stop) of the base64url `token`, i.e. just the 4
+  character groups that cover them.
+  """
+  first = start // 3
+  last = -(-stop // 3)
+
+  decoded = base64.urlsafe_b64decode(token[4 * first:4 * last])
+
+  return decoded[start - 3 * first:stop - 3 * first]
+
+
+def _urlsafe_b64decoded_length(token):
+  return len(token) // 4 * 3 - token[-2:].count("=")
+
+
+class _BufferFile(object):
+  """
+  A minimal file over a caller's buffer (`str`, `bytearray`, `memoryview`
+  or `mmap`), so the streaming methods can read from and write into it in
+  place.
+  """
+
+  def __init__(self, buf):
+    self._buf = buf
+    self._pos = 0
+
+  def read(self, size):
+    data = self._buf[self._pos:self._pos + size]
+    self._pos += len(data)
+
+    if isinstance(data, memoryview):
+      return data.tobytes()
+    return bytes(data)
+
+  def write(self, data):
+    self._buf[self._pos:self._pos + len(data)] = data
+    self._pos += len(data)
+
+  def seek(self, pos):
+    self._pos = pos
+
+
+# Streams are processed in chunks that are a multiple of both the AES block
+# size and the 3 byte base64 group.
+STREAM_CHUNK_SIZE = 48 * 1024
+
+# Records per unit of work handed to a worker pool by the batch methods.
+BATCH_SIZE = 1024
+
+# Messages of at least this many bytes are encrypted and decrypted in
+# segments of PARALLEL_SEGMENT_SIZE bytes when a pool is available.
+PARALLEL_THRESHOLD = 4 * 1024 * 1024
+PARALLEL_SEGMENT_SIZE = 1024 * 1024
+
+# Bytes of OS randomness an `IVPool` reads at a time.
+IV_POOL_CHUNK_SIZE = 64 * 1024
+
+# Defaults of a `ReplayGuard`: the false positive rate of each of its Bloom
+# filters, and how many filters the window is split into.
+REPLAY_ERROR_RATE = 0.001
+REPLAY_BUCKETS = 8
+
+# Token versions: AES-CTR with an AES-CMAC tag, single pass AES-GCM, and
+# AES-CTR/AES-CMAC over a compressed message.
+VERSION_CTR_CMAC = b"\x91"
+VERSION_GCM = b"\x92"
+VERSION_COMPRESSED = b"\x93"
+
+# Prefix of `FernetKeyRing` tokens, followed by a 16 bit key id.
+VERSION_KEY_ID = b"\x94"
+
+# The timestamp of deterministic tokens, which must not depend on the time.
+DETERMINISTIC_TIMESTAMP = struct.pack(">Q", 0)
+
+# Length of Version || Timestamp || IV
+HEADER_LENGTH = 1 + 8 + 16
+
 # From  RFC 4493, AES-CMAC  Constants:
 #   const_Zero is 0x00000000000000000000000000000000
 #   const_Rb   is 0x00000000000000000000000000000087
@@ -42,6 +223,504 @@ CONST_RB = byteblock(num([0x87]))
 CONST_ZERO = byteblock(0)
 
 
+# Compression codecs of 0x93 tokens, by name: (id byte, compress, decompress)
+CODECS = {}
+
+
+def register_codec(name, codec_id, compress, decompress):
+  """
+  Make a compression codec available as `Fernet(key, compression=name)`.
+  `codec_id` is the byte marking the codec in 0x93 headers, so it must be
+  registered under the same id wherever those tokens are decrypted.
+  """
+  for other, codec in CODECS.items():
+    if other != name and codec[0] == codec_id:
+      raise ValueError("Codec id {!r} is already taken by {}".format(codec_id, other))
+
+  CODECS[name] = (codec_id, compress, decompress)
+
+
+def _codec_by_id(codec_id):
+  for codec in CODECS.values():
+    if codec[0] == codec_id:
+      return codec
+
+  raise InvalidToken("Unknown compression codec: {!r}".format(codec_id))
+
+
+register_codec("zlib", b"\x01", zlib.compress, zlib.decompress)
+
+
+def _subkey(block):
+  """
+  One step of the RFC 4493 subkey generation:
+
+    if MSB(block) is equal to 0: K := block << 1;
+    else:                        K := (block << 1) XOR const_Rb;
+  """
+  bn = num(block)
+  return byteblock(bn << 1 if bn >> 127 == 0 else (bn << 1) ^ num(CONST_RB))
+
+
+class AESCMAC(object):
+  """
+  AES-CMAC as defined in RFC 4493, keyed once. The core of AES-CMAC is the
+  basic CBC-MAC.
+
+  To authenticate a message, the CBC-MAC is applied.  There are two cases
+  in CMAC. If the size of the input message block is equal to a positive
+  multiple of the block size, the last block is XOR'ed with K1 before
+  processing.  Otherwise, the last block is be padded with 10^i and
+  XOR'ed with K2,
+
+  K1 and K2 are subkeys generated by applying the PRF to `00000....`. They
+  only depend on the key, so they are computed here, once, and every tag
+  after that is a single AES-CBC pass over the message with a zero IV.
+
+  With `native=True` tags are computed by `cryptography`'s own `cmac.CMAC`
+  instead, copied from a context keyed here.
+  """
+
+  def __init__(self, key, backend, native=False):
+    self._cipher = ciphers.Cipher(ciphers.algorithms.AES(key),
+                                  ciphers.modes.CBC(CONST_ZERO),
+                                  backend)
+    self._native = None
+    if native:
+      self._native = cmac.CMAC(ciphers.algorithms.AES(key), backend)
+
+    # Generate the subkeys k1 and k2,
+
+    # Step 1
+    # L := AES-128(K, const_Zero);
+    encryptor = self._cipher.encryptor()
+    ls = encryptor.update(CONST_ZERO) + encryptor.finalize()
+
+    # Step 2
+    #   if MSB(L) is equal to 0: K1 := L << 1;
+    #   else                     K1 := (L << 1) XOR const_Rb;
+    self._k1 = _subkey(ls)
+
+    # Step 3
+    #   if MSB(K1) is equal to 0: K2 := K1 << 1;
+    #   else:                     K2 := (K1 << 1) XOR const_Rb;
+    self._k2 = _subkey(self._k1)
+
+  def context(self):
+    """
+    Return an incremental context with `update(data)` and `finalize()`.
+    """
+    if self._native is not None:
+      return _NativeCMACContext(self._native.copy())
+
+    return _CMACContext(self._cipher.encryptor(), self._k1, self._k2)
+
+  def tag(self, *data):
+    """
+    The tag of the concatenation of `data`, without concatenating it.
+    """
+    ctx = self.context()
+    for d in data:
+      ctx.update(d)
+    return ctx.finalize()
+
+
+class _CMACContext(object):
+  """
+  Incremental AES-CMAC. Whole blocks go straight through the CBC encryptor;
+  the last (possibly partial) block is held back because it can only be
+  tweaked once the end of the message is known.
+  """
+
+  def __init__(self, encryptor, k1, k2):
+    self._encryptor = encryptor
+    self._k1 = k1
+    self._k2 = k2
+    self._pending = bytearray()
+
+  def update(self, data):
+    data = memoryview(data)
+
+    if len(self._pending) + len(data) <= 16:
+      self._pending += data
+      return
+
+    # Complete the pending block, which is no longer the last one.
+    if self._pending:
+      fill = 16 - len(self._pending)
+      self._encryptor.update(bytes(self._pending + data[:fill]))
+      data = data[fill:]
+
+    # Always keep at least one byte (and at most one block) back.
+    n = (len(data) - 1) // 16 * 16
+    if n:
+      self._encryptor.update(data[:n])
+
+    self._pending = bytearray(data[n:])
+
+  def finalize(self):
+    last_block = bytes(self._pending)
+    last_block_len = len(last_block)
+
+    # Tweak the last block by XOR'ing with either subkey k1 or k2.
+    # If the last block is not 16 bytes, pad with the bit-string
+    # 10^i to adjust the length of the last block up to the block
+    # length.
+    if last_block_len < 16:
+      last_block = block_xor(
+        last_block + '\x80' + '\x00' * (15 - last_block_len),
+        self._k2)
+    else:
+      last_block = block_xor(last_block, self._k1)
+
+    tag = self._encryptor.update(last_block)
+    self._encryptor.finalize()
+
+    return tag
+
+
+class _NativeCMACContext(object):
+  """
+  `cmac.CMAC` only accepts bytes.
+  """
+
+  def __init__(self, native):
+    self._native = native
+
+  def update(self, data):
+    if isinstance(data, memoryview):
+      data = data.tobytes()
+    self._native.update(bytes(data))
+
+  def finalize(self):
+    return self._native.finalize()
+
+
+class IVPool(object):
+  """
+  A source of random IVs that reads randomness from the OS `chunk_size`
+  bytes at a time instead of one syscall per IV. Once half of the current
+  chunk has been handed out, the next one is read on a background thread.
+
+  Calling the pool returns `n` fresh random bytes, and `ivs` returns a list
+  of IVs. It is safe to share between threads, and after a fork the child
+  discards everything read before it, so parent and child never hand out
+  the same bytes.
+
+  The pool pays off for IVs drawn in bulk, e.g. by `Fernet.encrypt_many` or
+  through `ivs`: per IV that costs a fraction of `os.urandom(16)`. A single
+  16 byte call costs about as much as `os.urandom(16)` itself, since the
+  fork check and the lock are no cheaper than the syscall they save.
+  """
+
+  def __init__(self, chunk_size=IV_POOL_CHUNK_SIZE):
+    self._chunk_size = chunk_size
+
+    # A lock per process: a fork may copy a lock while another thread holds
+    # it, so a child never takes the locks of its parent.
+    self._locks = {}
+    self._reset(os.getpid())
+
+  def _process_lock(self, pid):
+    lock = self._locks.get(pid)
+    if lock is None:
+      # `setdefault` is atomic, so all threads of a new child agree on one.
+      lock = self._locks.setdefault(pid, threading.Lock())
+
+    return lock
+
+  def _reset(self, pid):
+    self._pid = pid
+    self._buffer = b""
+    self._offset = 0
+    self._next = None
+    self._refilling = False
+
+    for stale in [stale for stale in self._locks.keys() if stale != pid]:
+      del self._locks[stale]
+
+  def __call__(self, n=16):
+    if n > self._chunk_size:
+      return os.urandom(n)
+
+    pid = os.getpid()
+    with self._locks.get(pid) or self._process_lock(pid):
+      if self._pid != pid:
+        self._reset(pid)
+
+      if len(self._buffer) - self._offset < n:
+        if self._next is not None:
+          self._buffer, self._next = self._next, None
+        else:
+          self._buffer = os.urandom(self._chunk_size)
+        self._offset = 0
+
+      data = self._buffer[self._offset:self._offset + n]
+      self._offset += n
+
+      if (self._next is None and not self._refilling and
+              len(self._buffer) - self._offset < self._chunk_size // 2):
+        self._refilling = True
+        refill = threading.Thread(target=self._refill, args=(pid,))
+        refill.daemon = True
+        refill.start()
+
+    return data
+
+  def ivs(self, count, size=16):
+    """ `count` IVs of `size` bytes, drawn from the pool in one call. """
+    data = self(count * size)
+
+    return [data[i:i + size] for i in xrange(0, len(data), size)]
+
+  def _refill(self, pid):
+    data = os.urandom(self._chunk_size)
+
+    with self._process_lock(pid):
+      # Drop a chunk read for a process this pool no longer belongs to.
+      if self._pid == pid:
+        self._next = data
+        self._refilling = False
+
+
+class _BloomFilter(object):
+  """
+  A Bloom filter of `bits` bits with `hashes` probes per item, where the
+  probes are derived by double hashing from two 64 bit hashes of an item.
+  """
+
+  def __init__(self, bits, hashes):
+    self._bits = bits
+    self._hashes = hashes
+    self._array = bytearray((bits + 7) // 8)
+    self.count = 0
+
+    # Bits set so far, counted as they are set so `fill` is O(1).
+    self._set = 0
+
+  def _probes(self, h1, h2):
+    return [(h1 + i * h2) % self._bits for i in xrange(self._hashes)]
+
+  def __contains__(self, item):
+    return all(self._array[b >> 3] & (1 << (b & 7)) for b in self._probes(*item))
+
+  def add(self, item):
+    for b in self._probes(*item):
+      mask = 1 << (b & 7)
+      if not self._array[b >> 3] & mask:
+        self._array[b >> 3] |= mask
+        self._set += 1
+    self.count += 1
+
+  def fill(self):
+    """ The fraction of bits set. """
+    return self._set / float(self._bits)
+
+
+class ReplayGuard(object):
+  """
+  Remembers the (Timestamp, IV) pairs of decrypted tokens for `window`
+  seconds, so `Fernet.decrypt` can reject a token that is presented twice.
+
+  Memory is bounded: pairs go into one of `buckets` Bloom filters by
+  timestamp, each covering `window / buckets` seconds and sized for all of
+  the `capacity` tokens expected per window (traffic may be bursty) at
+  `error_rate` false positives. Buckets older than the window are dropped,
+  so `window` should match the `timetolive` tokens are decrypted with. A
+  token older than the window cannot be told apart from a replay and
+  counts as seen.
+
+  Bloom filters have no false negatives, so a replay is always caught; a
+  fresh token is wrongly rejected with probability about `error_rate`.
+  """
+
+  def __init__(self, window, capacity, error_rate=REPLAY_ERROR_RATE, buckets=REPLAY_BUCKETS):
+    self._window = window
+    self._width = max(int(math.ceil(window / float(buckets))), 1)
+
+    capacity = max(capacity, 1)
+    self._bits = int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+    self._hashes = max(int(round(self._bits / float(capacity) * math.log(2))), 1)
+
+    self._buckets = {}
+    self._lock = threading.Lock()
+
+    self.checks = 0
+    self.rejected = 0
+
+  def _item(self, timestamp, iv0):
+    return struct.unpack("<QQ", hashlib.md5(timestamp + iv0).digest())
+
+  def _prune(self, now):
+    """ Drop the buckets that have left the window. """
+    oldest = int(now - self._window) // self._width
+    for index in [index for index in self._buckets if index < oldest]:
+      del self._buckets[index]
+
+  def seen(self, timestamp, iv0, now=None):
+    """
+    Whether the pair may have been added before (or is too old to tell).
+    """
+    now = time.time() if now is None else now
+    msg_time = struct.unpack(">Q", timestamp)[0]
+    item = self._item(timestamp, iv0)
+
+    with self._lock:
+      self.checks += 1
+      self._prune(now)
+
+      bucket = self._buckets.get(msg_time // self._width)
+      if msg_time < now - self._window or (bucket is not None and item in bucket):
+        self.rejected += 1
+        return True
+
+    return False
+
+  def add(self, timestamp, iv0, now=None):
+    """
+    Remember the pair, returning False if it may have been added before (or
+    is too old to tell).
+    """
+    now = time.time() if now is None else now
+    msg_time = struct.unpack(">Q", timestamp)[0]
+    item = self._item(timestamp, iv0)
+
+    with self._lock:
+      self._prune(now)
+
+      if msg_time < now - self._window:
+        self.rejected += 1
+        return False
+
+      index = msg_time // self._width
+      if index not in self._buckets:
+        self._buckets[index] = _BloomFilter(self._bits, self._hashes)
+
+      bucket = self._buckets[index]
+      if item in bucket:
+        self.rejected += 1
+        return False
+
+      bucket.add(item)
+
+    return True
+
+  def stats(self):
+    """
+    Counters for monitoring: checks made, tokens rejected, and the items and
+    fraction of bits set in every live bucket(by bucket start time).
+    """
+    with self._lock:
+      buckets = dict((index * self._width, (bucket.count, bucket.fill()))
+                     for index, bucket in self._buckets.items())
+
+    return {"checks": self.checks, "rejected": self.rejected, "buckets": buckets}
+
+
+class TokenView(object):
+  """
+  The fields of a decoded Fernet token
+
+    Version || Timestamp || IV || Ciphertext || MAC
+
+  as `memoryview` slices of the one buffer, so nothing is copied out of it.
+  The timestamp is only unpacked when it is asked for. A view of the first
+  bytes of a token, e.g. its header, gives access to the fields they cover.
+  """
+  __slots__ = ("_buffer", "_view", "_timestamp")
+
+  def __init__(self, decoded):
+    self._buffer = decoded
+    self._view = memoryview(decoded)
+    self._timestamp = None
+
+  @classmethod
+  def decode(cls, token, chunk_size=STREAM_CHUNK_SIZE):
+    """
+    Decode `token` `chunk_size` characters at a time straight into the
+    buffer of the view, so no full size intermediate copy is made.
+    """
+    decoded = bytearray(_urlsafe_b64decoded_length(token))
+    decoder = Base64Decoder()
+
+    pos = 0
+    for i in xrange(0, len(token), chunk_size):
+      chunk = decoder.update(token[i:i + chunk_size])
+      decoded[pos:pos + len(chunk)] = chunk
+      pos += len(chunk)
+
+    chunk = decoder.finalize()
+    decoded[pos:pos + len(chunk)] = chunk
+    pos += len(chunk)
+
+    # Only off if the token was not well formed base64.
+    del decoded[pos:]
+
+    return cls(decoded)
+
+  @classmethod
+  def decode_header(cls, token):
+    """ A view of the (at most) HEADER_LENGTH leading bytes of `token`. """
+    return cls(_urlsafe_b64decode_slice(token, 0, HEADER_LENGTH))
+
+  def __len__(self):
+    return len(self._view)
+
+  @property
+  def version(self):
+    return self._view[:1].tobytes()
+
+  @property
+  def timestamp(self):
+    if self._timestamp is None:
+      self._timestamp = struct.unpack_from(">Q", self._buffer, 1)[0]
+
+    return self._timestamp
+
+  @property
+  def timestamp_bytes(self):
+    return self._view[1:9]
+
+  @property
+  def iv(self):
+    return self._view[9:HEADER_LENGTH]
+
+  @property
+  def header(self):
+    return self._view[:HEADER_LENGTH]
+
+  @property
+  def ciphertext(self):
+    return self._view[HEADER_LENGTH:-16]
+
+  @property
+  def tag(self):
+    return self._view[-16:]
+
+  @property
+  def authenticated(self):
+    """ Everything the 0x91 MAC covers: the header and the ciphertext. """
+    return self._view[:-16]
+
+  @property
+  def sealed(self):
+    """ Everything after the header: the 0x92 ciphertext and GCM tag. """
+    return self._view[HEADER_LENGTH:]
+
+
+class VerifiedToken(object):
+  """
+  A 0x91 token whose MAC a `Fernet` has verified, see `Fernet.verify`. It
+  holds the decoded token, so ranges of it are decrypted without decoding
+  or authenticating anything again.
+  """
+  __slots__ = ("view", "_fernet")
+
+  def __init__(self, view, fernet):
+    self.view = view
+    self._fernet = fernet
+
+
 class Fernet(object):
   """
    A Fernet 0x91 ciphertext is the base64url encoding of the concatenation of the following fields:
@@ -53,9 +732,45 @@ class Fernet(object):
     - IV, 128 bits
     - AES-CTR ciphertext, variable length, multiple of 8 bits (byte-aligned plaintexts only)
     - CMAC tag, 128 bits
+
+   A 0x92 ciphertext has the same layout, but the ciphertext and tag are
+   produced in a single pass by AES-256-GCM, with the IV as nonce and
+   Version || Timestamp || IV as associated data. Its 32 byte key is derived
+   from the signing key (the AES-CMAC tags of two constants), so no AES key
+   is shared between 0x92 tokens and the other versions.
+
+   A 0x93 ciphertext is a 0x91 ciphertext of the compressed message, with
+   one more byte in the (authenticated) header naming the codec:
+
+    Version || Timestamp || IV || Codec || Ciphertext || MAC
+
+   `decrypt` accepts all versions; `version` selects which of 0x91 and 0x92
+   `encrypt` and `encrypt_many` issue, unless a `compression` codec (see
+   `CODECS`) is given, in which case they issue 0x93 tokens. The streaming,
+   range and buffer methods only deal in 0x91 tokens.
+
+   Beware that compression makes the length of a token depend on the
+   content of the message, not just its length. Whenever an attacker can
+   get a secret encrypted in the same message as data they choose (or
+   simply knows what the candidate messages look like), the token lengths
+   can give the secret away, as in the CRIME and BREACH attacks. Only
+   compress messages whose content is not mixed like that.
+
+   IVs are read from `iv_source(n)`, `os.urandom` unless e.g. an `IVPool`
+   is given.
+
+   With `deterministic=True`, `encrypt` and `encrypt_many` issue tokens
+   whose IV is a synthetic IV: the AES-CMAC, under a key derived from the
+   signing key, of the message and the version (and codec) it is encrypted
+   under. Their timestamp is always 0, so equal messages give equal tokens
+   and can be deduplicated or cached. They are still ordinary, CMAC
+   authenticated tokens, but they reveal which messages are equal and can
+   not be decrypted with a time to live. Only 0x91 and 0x93 tokens can be
+   deterministic.
   """
 
-  def __init__(self, key, backend=None):
+  def __init__(self, key, backend=None, native_cmac=False, version=VERSION_CTR_CMAC,
+               iv_source=None, compression=None, deterministic=False):
     if backend is None:
       backend = default_backend()
 
@@ -65,183 +780,808 @@ class Fernet(object):
         "Fernet key must be 32 url-safe base64-encoded bytes."
       )
 
+    if version not in (VERSION_CTR_CMAC, VERSION_GCM):
+      raise ValueError("Unsupported Fernet version: {!r}".format(version))
+
+    if compression is not None and compression not in CODECS:
+      raise ValueError("Unknown compression codec: {}".format(compression))
+
+    if deterministic and version == VERSION_GCM and compression is None:
+      raise ValueError("Deterministic tokens can not be 0x92 tokens.")
+
     self._signing_key = key[:16]
     self._encryption_key = key[16:]
     self._backend = backend
+    self._native_cmac = native_cmac
+    self._version = version
+    self._compression = compression
+    self._deterministic = deterministic
+    self._iv_source = iv_source or os.urandom
+    self._authenticator = AESCMAC(self._signing_key, backend, native=native_cmac)
 
-  def _prf(self, key):
-    """
-    Return an AES block cipher function for the given key.
-
-    :param key:
-    :return:
-    """
-    cipher = ciphers.Cipher(ciphers.algorithms.AES(key),
-                            ciphers.modes.ECB(),
-                            self._backend)
+    # Keys of their own for GCM, so 0x92 tokens do not share key material
+    # with the CTR and CMAC keys, and for synthetic IVs, so they are not
+    # MACs of the token.
+    self._aead = AESGCM(self._authenticator.tag(b"Fernet GCM key 1") +
+                        self._authenticator.tag(b"Fernet GCM key 2"))
+    self._siv = AESCMAC(self._authenticator.tag(b"Fernet synthetic IV"), backend)
 
-    def _invoke(data):
-      encryptor = cipher.encryptor()
-      return encryptor.update(data) + encryptor.finalize()
+    # The pools made by `worker_pool`, whose workers hold this key.
+    self._pools = weakref.WeakSet()
 
-    return _invoke
 
-  def _ctr_blocks(self, iv0, data):
+  def _ctr(self, iv0, data, block_offset=0):
     """
-    Generator for AES block cipher - counter mode on `data` for the given
-    initialization vector. Each block of the message is XOR'ed with the
-    bytes of the AES PRF applied to `blk_vec`, which is the IV incremented
-    by 1 for each block. Note the least significant digit of `blk_vec` is
-    the highest index in the bytearry(big-endian).
+    AES block cipher - counter mode on `data` for the given initialization
+    vector. Each block of the message is XOR'ed with the bytes of the AES PRF
+    applied to `blk_vec`, which is the IV incremented by 1 for each block.
+    Note the least significant digit of `blk_vec` is the highest index in the
+    bytearry(big-endian), and the whole 128 bits are the counter (wrapping
+    at 2^128).
+
+    That is exactly the counter block OpenSSL's CTR mode increments, so the
+    whole keystream is generated and XOR'ed with `data` in a single native
+    call instead of one encryptor per block.
 
     :param iv0:
     :param data:
+    :param block_offset: start the counter this many blocks after `iv0`,
+                         so any block-aligned segment can be processed alone.
     :return:
     """
+    encryptor = self._ctr_encryptor(iv0, block_offset)
+
+    return encryptor.update(data) + encryptor.finalize()
+
+  def _ctr_encryptor(self, iv0, block_offset=0):
+    """
+    An incremental AES-CTR context for `_ctr`. Encrypting and decrypting are
+    the same operation.
+    """
     assert len(iv0) == 16
 
-    encrypt_prf = self._prf(self._encryption_key)
+    # `byteblock` keeps only the low 128 bits, so the counter wraps.
+    ctr0 = byteblock(num(iv0) + block_offset)
 
-    ivn = num(iv0)
+    return ciphers.Cipher(ciphers.algorithms.AES(self._encryption_key),
+                          ciphers.modes.CTR(ctr0),
+                          self._backend).encryptor()
 
-    while data:
-      blk_vec = byteblock(ivn)
-      cvx = encrypt_prf(blk_vec)
+  def _ctr_parallel(self, iv0, data, pool):
+    """
+    `_ctr` split into segments of PARALLEL_SEGMENT_SIZE bytes, segment k
+    starting at counter `iv0 + k * PARALLEL_SEGMENT_SIZE / 16`, computed on
+    the threads of `pool`. OpenSSL runs without the GIL, so the segments are
+    processed on as many cores as the pool has threads. Yields the segments
+    in order as they complete.
+    """
+    view = memoryview(data)
 
-      yield bytearray(ord(m) ^ ord(c) for m, c in zip(data[:16], cvx))
+    work = [(iv0, view[i:i + PARALLEL_SEGMENT_SIZE], i // 16)
+            for i in xrange(0, len(data), PARALLEL_SEGMENT_SIZE)]
 
-      data = data[16:]
-      ivn += 1
+    return pool.imap(self._ctr_segment, work)
 
-  def _cmac(self, data):
-    """
-    AES-CMAC as defined in RFC 4493. The core of AES-CMAC is the basic CBC-MAC.
+  def _ctr_segment(self, work):
+    return self._ctr(*work)
 
-    To authenticate a message, the CBC-MAC is applied.  There are two cases
-    in CMAC. If the size of the input message block is equal to a positive
-    multiple of the block size, the last block is XOR'ed with K1 before
-    processing.  Otherwise, the last block is be padded with 10^i and
-    XOR'ed with K2,
+  @classmethod
+  def _check_thread_pool(cls, pool):
+    # Segments are bound methods of this instance, which a process pool
+    # would have to pickle.
+    if pool is not None and not isinstance(pool, ThreadPool):
+      raise ValueError("Parallel segments need a thread pool, not a process pool.")
 
-    K1 and K2 are subkeys generated by applying the PRF to `00000....`
+  def _cmac(self, *data):
+    """
+    AES-CMAC of the concatenation of `data` under the signing key, see
+    `AESCMAC`.
 
     :param data:
     :return:
     """
+    return self._authenticator.tag(*data)
 
-    signing_prf = self._prf(self._signing_key)
+  @classmethod
+  def generate_key(cls):
+    return base64.urlsafe_b64encode(os.urandom(32))
 
-    # Generate the subkeys k1 and k2,
+  @classmethod
+  def peek(cls, token):
+    """
+    Return the version and timestamp of a Fernet ciphertext by decoding only
+    its first 12 base64 characters, whatever the length of the token.
 
-    # Step 1
-    # L := AES-128(K, const_Zero);
-    ls = signing_prf(CONST_ZERO)
-    ln = num(ls)
+    Nothing is authenticated, so this is only fit for deciding which tokens
+    are worth decrypting, e.g. sweeping a store for expired ones.
 
-    # Step 2
-    #   if MSB(L) is equal to 0: K1 := L << 1;
-    #   else                     K1 := (L << 1) XOR const_Rb;
-    k1 = byteblock(ln << 1 if ln >> 127 == 0 else (ln << 1) ^ num(CONST_RB))
+    :param token:
+    :return: (version, timestamp)
+    """
+    if len(token) < 12:
+      raise ValueError('The ciphertext must be at least 12 base64 characters(too short).')
 
-    # Step 3
-    #   if MSB(K1) is equal to 0: K2 := K1 << 1;
-    #   else:                     K2 := (K1 << 1) XOR const_Rb;
-    k1n = num(k1)
-    k2 = byteblock(k1n << 1 if k1n >> 127 == 0 else (k1n << 1) ^ num(CONST_RB))
+    view = TokenView(_urlsafe_b64decode_slice(token, 0, 9))
 
-    blocks = list(split_into_blocks(data, 16))
+    return view.version, view.timestamp
 
-    # Tweak the last block by XOR'ing with either subkey k1 or k2.
-    # If the last block is not 16 bytes, pad with the bit-string
-    # 10^i to adjust the length of the last block up to the block
-    # length.
-    last_block_len = len(blocks[-1])
+  def encrypt(self, data, iv0=None, pool=None):
+    """
+    Create a Fernet ciphertext (as described above) of this instance's
+    version, for a given plaintext
 
-    if last_block_len < 16:
-      last_block = block_xor(
-        blocks[-1] + '\x80' + '\x00' * (15 - last_block_len),
-        k2)
-    else:
-      last_block = block_xor(blocks[-1], k1)
+    With a thread `pool` (see `worker_pool`; a process pool raises
+    ValueError), 0x91 messages of PARALLEL_THRESHOLD bytes or more are
+    encrypted in segments on the pool, and the MAC of each segment is
+    computed while the following ones are being encrypted.
 
-    # Replace the last block with the tweaked block
-    blocks = blocks[:-1] + [last_block]
+    :param data:
+    :param iv0:
+    :param pool:
+    :return:
+    """
+    self._check_thread_pool(pool)
 
-    # Perform the AES-CBC algorithm main loop
-    tag = reduce(
-      lambda block, prev: signing_prf(block_xor(block, prev)),
-      blocks,
-      CONST_ZERO)
+    # For testing, an initialization vector can be provided
+    if not iv0 and not self._deterministic:
+      iv0 = self._iv_source(16)
 
-    return tag
+    timestamp = struct.pack(">Q", int(time.time()))
 
-  @classmethod
-  def generate_key(cls):
-    return base64.urlsafe_b64encode(os.urandom(32))
+    return self._encrypt(data, iv0, timestamp, pool)
 
-  def encrypt(self, data, iv0=None):
+  def _synthetic_iv(self, data):
     """
-    Create a 0x91 Fernet ciphertext (as described above), for a given plaintext
-
-    :param data:
-    :return:
+    The IV of a deterministic token for `data`. The version (and codec) are
+    part of it, so the same message encrypted as 0x91 and 0x93 tokens never
+    shares a CTR keystream.
     """
-    # For testing, an initialization vector can be provided
-    if not iv0:
-      iv0 = os.urandom(16)
+    if self._compression is None:
+      marker = VERSION_CTR_CMAC
+    else:
+      marker = VERSION_COMPRESSED + CODECS[self._compression][0]
 
-    blocks = tuple(str(block) for block in self._ctr_blocks(iv0, data))
+    return self._siv.tag(marker, data)
 
-    ctx = "%s" * len(blocks) % blocks
+  def _encrypt(self, data, iv0, timestamp, pool=None):
+    if self._deterministic:
+      timestamp = DETERMINISTIC_TIMESTAMP
+      if not iv0:
+        iv0 = self._synthetic_iv(data)
 
-    timestamp = struct.pack(">Q", int(time.time()))
+    if self._compression is not None:
+      codec_id, compress, _ = CODECS[self._compression]
+      header = VERSION_COMPRESSED + timestamp + iv0 + codec_id
+
+      ctx = self._ctr(iv0, compress(data))
+
+      return _urlsafe_b64encode_parts(header, ctx, self._cmac(header, ctx))
+
+    if self._version == VERSION_GCM:
+      header = VERSION_GCM + timestamp + iv0
+
+      return _urlsafe_b64encode_parts(header, self._aead.encrypt(iv0, data, header))
+
+    header = b"\x91" + timestamp + iv0
+
+    if pool is None or len(data) < PARALLEL_THRESHOLD:
+      ctx = self._ctr(iv0, data)
 
-    mac = self._cmac(b"\x91" + timestamp + iv0 + ctx)
+      return _urlsafe_b64encode_parts(header, ctx, self._cmac(header, ctx))
 
-    output = b"\x91" + timestamp + iv0 + ctx + mac
+    auth = self._authenticator.context()
+    auth.update(header)
 
-    return base64.urlsafe_b64encode(output)
+    # Each segment is encoded as it completes, so neither the whole
+    # ciphertext nor the raw token is ever assembled.
+    encoder = Base64Encoder()
+    encoded = [encoder.update(header)]
 
-  def decrypt(self, token, timetolive=None):
+    for segment in self._ctr_parallel(iv0, data, pool):
+      auth.update(segment)
+      encoded.append(encoder.update(segment))
+
+    encoded.append(encoder.update(auth.finalize()))
+    encoded.append(encoder.finalize())
+
+    return b"".join(encoded)
+
+  def decrypt(self, token, timetolive=None, pool=None, ttl_first=False, replay_guard=None):
     """
-    Validate and decrypt a 0x91 Fernet ciphertext and return the original message.
+    Validate and decrypt a 0x91, 0x92 or 0x93 Fernet ciphertext and return the original message.
+
+    With a thread `pool` (see `worker_pool`; a process pool raises
+    ValueError), large messages are decrypted in segments on the pool while
+    the MAC is computed alongside them. The message is still only returned
+    once the MAC has been verified.
+
+    With `ttl_first=True` an expired token is rejected from its (not yet
+    authenticated) header alone, before any decoding or MAC work on the
+    rest of it.
+
+    With a `replay_guard` (a `ReplayGuard`), a token whose timestamp and IV
+    were seen before is rejected from its header, before the MAC is
+    computed; a token is only remembered once it has been verified.
 
     :param token:
     :param timetolive:
-    :param kwargs:
+    :param pool:
+    :param ttl_first:
+    :param replay_guard:
     :return:
     """
+    self._check_thread_pool(pool)
 
-    decoded = base64.urlsafe_b64decode(token)
+    if ttl_first and timetolive:
+      self._verify_timestamp(self.peek(token)[1], timetolive)
 
-    # Ensure the cipher text is long enough to contain a version,
-    # timestamp, initialization vector, and CMAC tag.
-    min_length = 1 + 8 + 16 + 16
-    if len(decoded) < min_length:
+    if replay_guard is None:
+      return self._decrypt(token, timetolive, pool)
+
+    header = TokenView.decode_header(token)
+    timestamp, iv0 = header.timestamp_bytes.tobytes(), header.iv.tobytes()
+
+    if len(header) == HEADER_LENGTH and replay_guard.seen(timestamp, iv0):
+      raise InvalidToken("Token has already been used")
+
+    msg = self._decrypt(token, timetolive, pool)
+
+    # Two copies of a token may have been verified concurrently.
+    if not replay_guard.add(timestamp, iv0):
+      raise InvalidToken("Token has already been used")
+
+    return msg
+
+  def _decrypt(self, token, timetolive, pool):
+    if _urlsafe_b64decode_slice(token, 0, 1) == VERSION_GCM:
+      return self._decrypt_gcm(token, timetolive)
+
+    if _urlsafe_b64decode_slice(token, 0, 1) == VERSION_COMPRESSED:
+      return self._decrypt_compressed(token, timetolive)
+
+    # The threshold is in message bytes, as for `encrypt`.
+    msg_length = _urlsafe_b64decoded_length(token) - HEADER_LENGTH - 16
+    if pool is None or msg_length < PARALLEL_THRESHOLD:
+      view = self._verify(token, timetolive)
+
+      # Perform AES-CTR decryption
+      return self._ctr(view.iv, view.ciphertext)
+
+    view = self._disassemble(token)
+
+    auth_mac = pool.apply_async(self._cmac, (view.authenticated,))
+
+    # Perform AES-CTR decryption
+    msg = b"".join(self._ctr_parallel(view.iv, view.ciphertext, pool))
+
+    # Verify MAC is correct
+    if auth_mac.get() != view.tag.tobytes():
+      raise InvalidToken("Message authentication code is invalid")
+
+    # Verify timestamp has not expired
+    self._verify_timestamp(view.timestamp, timetolive)
+
+    return msg
+
+  def _decrypt_gcm(self, token, timetolive):
+    """
+    Validate and decrypt a 0x92 Fernet ciphertext.
+    """
+    view = TokenView.decode(token)
+
+    min_length = HEADER_LENGTH + 16
+    if len(view) < min_length:
       raise ValueError('The ciphertext must exceed {} bytes(too short).'.format(min_length))
 
-    # Disassemble the message.
-    version, timestamp, iv0, ctx, token_mac = decoded[0], decoded[1:9], decoded[9:25], decoded[25:-16], decoded[-16:]
+    try:
+      msg = self._aead.decrypt(view.iv, view.sealed.tobytes(), view.header.tobytes())
+    except InvalidTag:
+      raise InvalidToken("Message authentication code is invalid")
 
-    # Ensure version is correct
-    if version != '\x91':
-      raise InvalidToken("Invalid version token: {}".format(token[0]))
+    # Verify timestamp has not expired
+    self._verify_timestamp(view.timestamp, timetolive)
+
+    return msg
+
+  def _decrypt_compressed(self, token, timetolive):
+    """
+    Validate and decrypt a 0x93 Fernet ciphertext.
+    """
+    view = self._verify(token, timetolive, VERSION_COMPRESSED)
+
+    # The first byte after the header names the codec.
+    _, _, decompress = _codec_by_id(view.ciphertext[:1].tobytes())
+
+    # Perform AES-CTR decryption
+    return decompress(self._ctr(view.iv, view.ciphertext[1:]))
+
+  def _verify(self, token, timetolive, version=VERSION_CTR_CMAC):
+    """
+    Validate a 0x91 Fernet ciphertext, returning its `TokenView`.
+    """
+    view = self._disassemble(token, version)
 
     # Verify MAC is correct
-    auth_mac = self._cmac(b"\x91" + timestamp + iv0 + ctx)
-    if auth_mac != token_mac:
+    auth_mac = self._cmac(view.authenticated)
+    if auth_mac != view.tag.tobytes():
       raise InvalidToken("Message authentication code is invalid")
 
     # Verify timestamp has not expired
-    msg_time = struct.unpack(">Q", timestamp)[0]
+    self._verify_timestamp(view.timestamp, timetolive)
+
+    return view
+
+  def _disassemble(self, token, version=VERSION_CTR_CMAC):
+    view = TokenView.decode(token)
+
+    # Ensure the cipher text is long enough to contain a version,
+    # timestamp, initialization vector, (codec,) and CMAC tag.
+    min_length = 1 + 8 + 16 + 16 + (version == VERSION_COMPRESSED)
+    if len(view) < min_length:
+      raise ValueError('The ciphertext must exceed {} bytes(too short).'.format(min_length))
 
+    # Ensure version is correct
+    if view.version != version:
+      raise InvalidToken("Invalid version token: {}".format(token[0]))
+
+    return view
+
+  def verify(self, token, timetolive=None):
+    """
+    Validate a 0x91 Fernet ciphertext once, returning a `VerifiedToken` to
+    pass to `decrypt_range` for any number of ranges of it.
+
+    :param token:
+    :param timetolive:
+    :return:
+    """
+    return VerifiedToken(self._verify(token, timetolive), self)
+
+  def decrypt_range(self, token, offset, length, timetolive=None):
+    """
+    Validate a 0x91 Fernet ciphertext and return `length` bytes of the
+    original message starting at `offset` (fewer at the end of the message).
+
+    Block i of an AES-CTR message only depends on the counter `iv0 + i`, so
+    only the blocks covering the range are decrypted. The MAC still covers
+    the whole token, so a token string is decoded and verified in full on
+    every call; `token` may instead be a `VerifiedToken` from `verify`, of
+    which a range costs only the blocks it covers.
+
+    :param token:
+    :param offset:
+    :param length:
+    :param timetolive:
+    :return:
+    """
+    if offset < 0 or length < 0:
+      raise ValueError("Offset and length must not be negative.")
+
+    if not isinstance(token, VerifiedToken):
+      view = self._verify(token, timetolive)
+    elif token._fernet is not self:
+      raise ValueError("The token was verified by another Fernet.")
+    else:
+      view = token.view
+
+      # Verify timestamp has not expired
+      self._verify_timestamp(view.timestamp, timetolive)
+
+    first_block = offset // 16
+    ctx = view.ciphertext[16 * first_block:offset + length]
+
+    # Perform AES-CTR decryption of the covering blocks
+    return self._ctr(view.iv, ctx, block_offset=first_block)[offset - 16 * first_block:]
+
+  def _verify_timestamp(self, msg_time, timetolive):
     curr_time = time.time()
 
     if timetolive and msg_time + timetolive < curr_time:
       raise InvalidToken("Timestamp {} exceeds time to live {}".format(msg_time, timetolive))
 
+  def encrypt_stream(self, reader, writer, iv0=None, chunk_size=STREAM_CHUNK_SIZE):
+    """
+    Encrypt everything read from the file-like `reader` into a 0x91 Fernet
+    ciphertext written to `writer`. The token is the same as the one
+    `encrypt(reader.read())` would return, but is produced `chunk_size` bytes
+    at a time: the CTR counter and the CMAC are carried across chunks and the
+    base64url output is written as it goes, so memory does not depend on
+    the size of the payload.
+
+    :param reader:
+    :param writer:
+    :param iv0:
+    :param chunk_size:
+    :return:
+    """
+    if not iv0:
+      iv0 = self._iv_source(16)
+
+    timestamp = struct.pack(">Q", int(time.time()))
+    header = b"\x91" + timestamp + iv0
+
+    encryptor = self._ctr_encryptor(iv0)
+    auth = self._authenticator.context()
+    auth.update(header)
+
+    encoder = Base64Encoder()
+    writer.write(encoder.update(header))
+
+    while True:
+      data = reader.read(chunk_size)
+      if not data:
+        break
+
+      ctx = encryptor.update(data)
+      auth.update(ctx)
+
+      writer.write(encoder.update(ctx))
+
+    encryptor.finalize()
+
+    writer.write(encoder.update(auth.finalize()) + encoder.finalize())
+
+  def decrypt_stream(self, reader, writer, timetolive=None, spool=None,
+                     unverified=False, chunk_size=STREAM_CHUNK_SIZE):
+    """
+    Validate and decrypt a 0x91 Fernet ciphertext read from the file-like
+    `reader`, writing the original message to `writer` in `chunk_size`
+    pieces.
+
+    No plaintext is written until the MAC has been verified: the raw
+    ciphertext is spooled to `spool` (an empty file, by default a temporary
+    file) while the CMAC is computed, and only decrypted from there once the
+    tag matches.
+
+    With `unverified=True` there is no spool, plaintext is written to
+    `writer` as soon as it is decrypted and InvalidToken is raised at the
+    end if the tag does not match. Whatever was written must then be
+    discarded by the caller.
+
+    :param reader:
+    :param writer:
+    :param timetolive:
+    :param spool:
+    :param unverified:
+    :param chunk_size:
+    :return:
+    """
+    if not unverified and spool is None:
+      spool = tempfile.TemporaryFile()
+
+    auth = self._authenticator.context()
+    header = b""
+    decryptor = None
+
+    # The last 16 bytes seen so far; the CMAC tag once the stream ends.
+    tail = b""
+
+    for decoded in _urlsafe_b64decode_chunks(reader, chunk_size):
+      if len(header) < HEADER_LENGTH:
+        n = HEADER_LENGTH - len(header)
+        header, decoded = header + decoded[:n], decoded[n:]
+
+        if len(header) < HEADER_LENGTH:
+          continue
+
+        # Ensure version is correct
+        if header[0] != '\x91':
+          raise InvalidToken("Invalid version token: {}".format(header[0]))
+
+        auth.update(header)
+        decryptor = self._ctr_encryptor(header[9:25])
+
+      tail += decoded
+      ctx, tail = tail[:-16], tail[-16:]
+      if not ctx:
+        continue
+
+      auth.update(ctx)
+
+      if unverified:
+        writer.write(decryptor.update(ctx))
+      else:
+        spool.write(ctx)
+
+    # Ensure the cipher text is long enough to contain a version,
+    # timestamp, initialization vector, and CMAC tag.
+    min_length = HEADER_LENGTH + 16
+    if len(header) + len(tail) < min_length:
+      raise ValueError('The ciphertext must exceed {} bytes(too short).'.format(min_length))
+
+    # Verify MAC is correct
+    if auth.finalize() != tail:
+      raise InvalidToken("Message authentication code is invalid")
+
+    # Verify timestamp has not expired
+    self._verify_timestamp(TokenView(header).timestamp, timetolive)
+
+    if unverified:
+      return
+
     # Perform AES-CTR decryption
-    blocks = tuple(str(block) for block in self._ctr_blocks(iv0, ctx))
-    msg = "%s" * len(blocks) % blocks
+    spool.seek(0)
+    while True:
+      ctx = spool.read(chunk_size)
+      if not ctx:
+        break
 
-    return msg
+      writer.write(decryptor.update(ctx))
+
+  @classmethod
+  def encrypted_size(cls, length):
+    """
+    The size of the buffer `encrypt_into` needs for a `length` byte message,
+    i.e. the length of its token.
+    """
+    return -(-(HEADER_LENGTH + length + 16) // 3) * 4
+
+  @classmethod
+  def decrypted_size(cls, token):
+    """
+    The size of the buffer `decrypt_into` needs for `token`, i.e. the
+    length of its message.
+    """
+    # Only the last two characters can be padding.
+    padding_length = bytearray(token[-2:]).count(b"=")
+
+    return max(len(token) // 4 * 3 - padding_length - HEADER_LENGTH - 16, 0)
+
+  def encrypt_into(self, buf, data, iv0=None):
+    """
+    Create a 0x91 Fernet ciphertext for `data` directly in the caller's
+    writable buffer `buf`, returning its length. Both may be a `bytearray`,
+    `memoryview` or `mmap` (and `data` a `str`). `buf` must have room for
+    at least `encrypted_size(len(data))` bytes.
+
+    The token is produced as by `encrypt_stream`, so no full size copy of
+    the message, ciphertext or token is ever made.
+
+    :param buf:
+    :param data:
+    :param iv0:
+    :return:
+    """
+    size = self.encrypted_size(len(data))
+    if len(buf) < size:
+      raise ValueError("The buffer must hold at least {} bytes.".format(size))
+
+    self.encrypt_stream(_BufferFile(data), _BufferFile(buf), iv0=iv0)
+
+    return size
+
+  def decrypt_into(self, buf, token, timetolive=None):
+    """
+    Validate and decrypt a 0x91 Fernet ciphertext directly into the
+    caller's writable buffer `buf`, returning the length of the message.
+    Both may be a `bytearray`, `memoryview` or `mmap` (and `token` a
+    `str`). `buf` must have room for at least `decrypted_size(token)` bytes.
+
+    `buf` itself is the spool of `decrypt_stream`: the ciphertext is decoded
+    into it and, once the MAC has been verified, decrypted in place. If the
+    token is invalid `buf` holds (part of) the ciphertext, never plaintext.
+
+    :param buf:
+    :param token:
+    :param timetolive:
+    :return:
+    """
+    size = self.decrypted_size(token)
+    if len(buf) < size:
+      raise ValueError("The buffer must hold at least {} bytes.".format(size))
+
+    self.decrypt_stream(_BufferFile(token), _BufferFile(buf),
+                        timetolive=timetolive, spool=_BufferFile(buf))
+
+    return size
+
+  def worker_pool(self, workers=None, processes=False):
+    """
+    Create a pool of `workers` threads (or processes) for `encrypt_many` and
+    `decrypt_many`. Every worker holds its own Fernet for this key, so a
+    process pool never has to pickle the cipher state, and the pool only
+    serves this instance. The caller owns the pool and should `close()` it
+    when done.
+
+    :param workers: defaults to the number of CPUs
+    :param processes:
+    :return:
+    """
+    key = base64.urlsafe_b64encode(self._signing_key + self._encryption_key)
+    pool_type = Pool if processes else ThreadPool
+
+    pool = pool_type(workers, _init_worker,
+                     (key, self._native_cmac, self._version, self._compression,
+                      self._deterministic))
+    self._pools.add(pool)
+
+    return pool
+
+  def encrypt_many(self, data, pool=None, batch_size=BATCH_SIZE):
+    """
+    Encrypt every plaintext in the iterable `data`, returning a list of
+    tokens in the same order. All tokens share one timestamp and the IVs are
+    drawn from the IV source in one call.
+
+    If `pool` (see `worker_pool`) is given and there is more than one batch
+    of `batch_size` records, the batches are encrypted by the pool's
+    workers. A record that cannot be encrypted gets its exception in place
+    of a token rather than failing the whole batch.
+
+    :param data:
+    :param pool:
+    :param batch_size:
+    :return:
+    """
+    data = list(data)
+
+    timestamp = struct.pack(">Q", int(time.time()))
+    ivs = b"" if self._deterministic else self._iv_source(16 * len(data))
+
+    work = [("_encrypt_batch", (data[i:i + batch_size], ivs[16 * i:16 * (i + batch_size)], timestamp))
+            for i in xrange(0, len(data), batch_size)]
+
+    return self._run_batches(work, pool)
+
+  def decrypt_many(self, tokens, ttl=None, pool=None, batch_size=BATCH_SIZE):
+    """
+    Validate and decrypt every token in the iterable `tokens`, returning a
+    list of plaintexts in the same order. A token that is invalid (or
+    older than `ttl`) gets its exception in place of a plaintext.
+
+    See `encrypt_many` for `pool` and `batch_size`.
+
+    :param tokens:
+    :param ttl:
+    :param pool:
+    :param batch_size:
+    :return:
+    """
+    tokens = list(tokens)
+
+    work = [("_decrypt_batch", (tokens[i:i + batch_size], ttl))
+            for i in xrange(0, len(tokens), batch_size)]
+
+    return self._run_batches(work, pool)
+
+  def _run_batches(self, work, pool):
+    # The workers of another instance's pool would use its key.
+    if pool is not None and pool not in self._pools:
+      raise ValueError("The pool was not created by this Fernet's worker_pool.")
+
+    if pool is None or len(work) < 2:
+      results = [getattr(self, method)(*args) for method, args in work]
+    else:
+      results = pool.map(_worker_call, work)
+
+    return list(itertools.chain.from_iterable(results))
+
+  def _encrypt_batch(self, data, ivs, timestamp):
+    results = []
+    for i, msg in enumerate(data):
+      try:
+        results.append(self._encrypt(msg, ivs[16 * i:16 * i + 16], timestamp))
+      except (TypeError, ValueError) as e:
+        results.append(e)
+
+    return results
+
+  def _decrypt_batch(self, tokens, timetolive):
+    results = []
+    for token in tokens:
+      try:
+        results.append(self.decrypt(token, timetolive))
+      except (InvalidToken, TypeError, ValueError) as e:
+        results.append(e)
+
+    return results
+
+
+class FernetKeyRing(object):
+  """
+  Several Fernet keys, the first of which (the primary key) encrypts while
+  all of them decrypt, so keys can be rotated without re-encrypting
+  everything at once.
+
+  Tokens from `encrypt` are the base64url encoding of
+
+    0x94 || Key ID || Fernet ciphertext
+
+  where the Key ID is 16 bits derived from the key. Those 3 bytes are
+  exactly 4 base64 characters, so the Fernet token follows them unchanged
+  and `decrypt` finds its key with one dict lookup, whatever the number of
+  retired keys. Tokens without a key id (e.g. made by a plain `Fernet`)
+  are tried against every key, starting with the one that most recently
+  decrypted such a token.
+
+  Each key keeps its own `Fernet`, so the CMAC subkeys and cipher state are
+  only set up once. Keyword arguments are passed to every one of them.
+  """
+
+  def __init__(self, keys, **kwargs):
+    keys = list(keys)
+    if not keys:
+      raise ValueError("A key ring needs at least one key.")
+
+    self._kwargs = kwargs
+    self._lock = threading.Lock()
+
+    # key id -> Fernets, and every Fernet, most recently successful first.
+    self._by_id = {}
+    self._recent = []
+
+    for key in reversed(keys):
+      self.rotate(key)
+
+  @classmethod
+  def key_id(cls, fernet):
+    """ The Key ID of a `Fernet`, a tag of a constant under its signing key. """
+    return fernet._cmac(b"Fernet key id")[:2]
+
+  def rotate(self, key):
+    """ Make `key` the primary key; the previous ones still decrypt. """
+    fernet = Fernet(key, **self._kwargs)
+    key_id = self.key_id(fernet)
+
+    with self._lock:
+      self._primary = fernet
+      self._prefix = base64.urlsafe_b64encode(VERSION_KEY_ID + key_id)
+      self._by_id.setdefault(key_id, []).insert(0, fernet)
+      self._recent.insert(0, fernet)
+
+  def encrypt(self, data, **kwargs):
+    """ `Fernet.encrypt` under the primary key, prefixed by its key id. """
+    with self._lock:
+      fernet, prefix = self._primary, self._prefix
+
+    return prefix + fernet.encrypt(data, **kwargs)
+
+  def decrypt(self, token, timetolive=None, **kwargs):
+    """
+    `Fernet.decrypt` under the key named by the token's key id, or, for a
+    token without one, under each key in turn.
+    """
+    prefix = base64.urlsafe_b64decode(token[:4]) if len(token) >= 4 else b""
+
+    legacy = prefix[:1] != VERSION_KEY_ID
+    with self._lock:
+      candidates = list(self._recent if legacy else self._by_id.get(prefix[1:], []))
+
+    if not legacy:
+      token = token[4:]
+
+    error = InvalidToken("No key of the key ring matches the token")
+    for fernet in candidates:
+      try:
+        msg = fernet.decrypt(token, timetolive, **kwargs)
+      except InvalidToken as e:
+        error = e
+        continue
+
+      if legacy:
+        self._promote(fernet)
+
+      return msg
+
+    raise error
+
+  def _promote(self, fernet):
+    with self._lock:
+      if self._recent[0] is not fernet:
+        self._recent.remove(fernet)
+        self._recent.insert(0, fernet)
+
+
+# The Fernet of a `Fernet.worker_pool` worker, thread-local so pools for
+# different keys can coexist in one process.
+_worker = threading.local()
+
+
+def _init_worker(key, native_cmac, version, compression, deterministic):
+  _worker.fernet = Fernet(key, native_cmac=native_cmac, version=version,
+                          compression=compression, deterministic=deterministic)
+
+
+def _worker_call(work):
+  method, args = work
+  return getattr(_worker.fernet, method)(*args)
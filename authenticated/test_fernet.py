@@ -1,14 +1,32 @@
-from authenticated.fernet import Fernet, InvalidToken, num, byteblock
+from authenticated import fernet as fernet_module
+from authenticated.fernet import Fernet, InvalidToken, TokenView, Base64Encoder, Base64Decoder, AESCMAC, IVPool, ReplayGuard, VerifiedToken, STREAM_CHUNK_SIZE, VERSION_GCM, VERSION_COMPRESSED, CODECS, FernetKeyRing, register_codec, num, byteblock
 
 import pytest
 import base64
 import os
+import random
+import signal
 import time
 import binascii
+import io
+import mmap
 import struct
+import zlib
+from multiprocessing.pool import ThreadPool
 
+from cryptography.exceptions import InvalidTag
 from cryptography.hazmat.primitives import cmac, ciphers
 from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+
+def spy(obj, name):
+  """ Wrap the method `name` of `obj`, returning the list its calls' arguments go to. """
+  calls = []
+  method = getattr(obj, name)
+  setattr(obj, name, lambda *args, **kwargs: calls.append(args) or method(*args, **kwargs))
+
+  return calls
 
 
 def test_num():
@@ -40,6 +58,194 @@ def test_byteblock():
     338953138925153547590470800371487866880)
 
 
+def test_base64_codec():
+  for length in (0, 1, 2, 3, 4, 100, 1000):
+    data = os.urandom(length)
+    encoded = base64.urlsafe_b64encode(data)
+
+    for step in (1, 2, 3, 5, 7, 64):
+      encoder = Base64Encoder()
+      chunks = [encoder.update(data[i:i + step]) for i in range(0, length, step)]
+      assert b"".join(chunks) + encoder.finalize() == encoded
+
+      decoder = Base64Decoder()
+      chunks = [decoder.update(encoded[i:i + step]) for i in range(0, len(encoded), step)]
+      assert b"".join(chunks) + decoder.finalize() == data
+
+  # A token decoded in small chunks is the same as decoded at once.
+  ctxe = Fernet(Fernet.generate_key()).encrypt(os.urandom(100))
+  assert TokenView.decode(ctxe, chunk_size=8).authenticated.tobytes() == \
+         base64.urlsafe_b64decode(ctxe)[:-16]
+
+
+class TestIVPool:
+
+  def test_Functionality(self):
+    pool = IVPool(chunk_size=256)
+
+    ivs = [pool() for _ in xrange(1000)]
+    assert all(len(iv) == 16 for iv in ivs)
+    assert len(set(ivs)) == len(ivs)
+
+    assert len(pool(1000)) == 1000
+
+    ivs = pool.ivs(100) + pool.ivs(100)
+    assert all(len(iv) == 16 for iv in ivs)
+    assert len(set(ivs)) == len(ivs)
+
+    # Concurrent callers never share bytes.
+    threads = ThreadPool(8)
+    ivs = threads.map(lambda _: pool(), xrange(2000))
+    threads.close()
+    assert len(set(ivs)) == len(ivs)
+
+  def test_Fork(self):
+    pool = IVPool()
+    pool()
+
+    r, w = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+      os.write(w, pool())
+      os._exit(0)
+
+    os.waitpid(pid, 0)
+    assert os.read(r, 16) != pool()
+
+    # A fork while the lock is held does not leave the child locked out.
+    with pool._process_lock(os.getpid()):
+      pid = os.fork()
+      if pid == 0:
+        signal.alarm(5)
+        os.write(w, pool())
+        os._exit(0)
+
+    assert os.waitpid(pid, 0)[1] == 0
+    assert len(os.read(r, 16)) == 16
+
+    # Threads of a new child agree on one lock, and none of them sees the
+    # buffer reset under it.
+    pid = os.fork()
+    if pid == 0:
+      signal.alarm(5)
+      threads = ThreadPool(8)
+      ivs = threads.map(lambda _: pool(), xrange(2000))
+      os._exit(0 if len(set(ivs)) == 2000 and all(len(iv) == 16 for iv in ivs) else 1)
+
+    assert os.waitpid(pid, 0)[1] == 0
+
+  def test_Fernet(self):
+    key = Fernet.generate_key()
+    fernet = Fernet(key, iv_source=IVPool())
+
+    ctxes = [fernet.encrypt("secret") for _ in xrange(100)] + fernet.encrypt_many(["secret"] * 100)
+    assert len(set(base64.urlsafe_b64decode(ctxe)[9:25] for ctxe in ctxes)) == 200
+    assert all(Fernet(key).decrypt(ctxe) == "secret" for ctxe in ctxes)
+
+
+class TestReplayGuard:
+
+  def test_Functionality(self):
+    guard = ReplayGuard(window=60, capacity=1000)
+    now = 1000000
+    timestamp = struct.pack(">Q", int(now))
+
+    # Fixed time and seeded IVs, so the test does not depend on luck.
+    rng = random.Random(1)
+    random_iv = lambda: struct.pack("<QQ", rng.getrandbits(64), rng.getrandbits(64))
+
+    ivs = [random_iv() for _ in xrange(1000)]
+    # A fresh pair may (rarely) be a false positive already.
+    fresh = sum(not guard.seen(timestamp, iv, now=now) and guard.add(timestamp, iv, now=now)
+                for iv in ivs)
+    assert fresh > 990
+
+    # No false negatives...
+    assert all(guard.seen(timestamp, iv, now=now) for iv in ivs)
+    assert not any(guard.add(timestamp, iv, now=now) for iv in ivs)
+
+    # ...and false positives near the configured rate.
+    false_positives = sum(guard.seen(timestamp, random_iv(), now=now) for _ in xrange(10000))
+    assert false_positives < 100
+
+    stats = guard.stats()
+    assert stats["rejected"] == 3000 - fresh + false_positives
+    assert sum(count for count, fill in stats["buckets"].values()) == fresh
+    assert all(0 < fill < 1 for count, fill in stats["buckets"].values())
+
+    # The fill is counted as bits are set, and matches the bits actually set.
+    for bucket in guard._buckets.values():
+      set_bits = sum(bin(byte).count("1") for byte in bucket._array)
+      assert bucket.fill() == set_bits / float(bucket._bits)
+
+  def test_Window(self):
+    guard = ReplayGuard(window=60, capacity=100, buckets=4)
+    now = 1000000
+    iv = os.urandom(16)
+
+    assert guard.add(struct.pack(">Q", now), iv, now=now)
+
+    # Too old to tell apart from a replay.
+    assert guard.seen(struct.pack(">Q", now - 61), os.urandom(16), now=now)
+    assert not guard.add(struct.pack(">Q", now - 61), os.urandom(16), now=now)
+
+    # Buckets age out with the window.
+    assert len(guard.stats()["buckets"]) == 1
+    guard.seen(struct.pack(">Q", now + 100), iv, now=now + 100)
+    assert len(guard.stats()["buckets"]) == 0
+
+
+class TestFernetKeyRing:
+  def setup_method(self, method):
+    self.keys = [Fernet.generate_key() for _ in range(25)]
+    self.ring = FernetKeyRing(self.keys)
+
+  def test_Rotation(self):
+    msg0 = os.urandom(100)
+
+    ctxe = self.ring.encrypt(msg0)
+    assert base64.urlsafe_b64decode(ctxe[:4])[0] == b"\x94"
+    assert Fernet(self.keys[0]).decrypt(ctxe[4:]) == msg0
+    assert self.ring.decrypt(ctxe) == msg0
+
+    # Tokens under a retired key are found by their key id alone.
+    self.ring.rotate(Fernet.generate_key())
+    assert self.ring.decrypt(ctxe) == msg0
+    assert self.ring.decrypt(self.ring.encrypt(msg0)) == msg0
+
+    with pytest.raises(InvalidToken):
+      FernetKeyRing([Fernet.generate_key()]).decrypt(ctxe)
+
+    with pytest.raises(InvalidToken):
+      self.ring.decrypt(ctxe, timetolive=-10)
+
+    with pytest.raises(ValueError):
+      FernetKeyRing([])
+
+  def test_KeyIdLookup(self):
+    ctxe = self.ring.encrypt(b"message")
+
+    calls = [spy(fernet, "_cmac") for fernets in self.ring._by_id.values() for fernet in fernets]
+
+    assert self.ring.decrypt(ctxe) == b"message"
+
+    # Only the key(s) with the token's id are tried, almost always one.
+    key_id = base64.urlsafe_b64decode(ctxe[:4])[1:]
+    assert sum(map(len, calls)) <= len(self.ring._by_id[key_id]) < 3
+
+  def test_LegacyTokens(self):
+    legacy = Fernet(self.keys[-1]).encrypt(b"message")
+
+    assert self.ring.decrypt(legacy) == b"message"
+
+    # The key that decrypted the last legacy token is tried first.
+    assert self.ring._recent[0]._signing_key == Fernet(self.keys[-1])._signing_key
+    assert self.ring.decrypt(legacy) == b"message"
+
+    with pytest.raises(InvalidToken):
+      self.ring.decrypt(Fernet(Fernet.generate_key()).encrypt(b"message"))
+
+
 # noinspection PyAttributeOutsideInit
 class TestFernet:
 
@@ -94,6 +300,119 @@ class TestFernet:
     with pytest.raises(InvalidToken):
       self.fernet.decrypt(ctxe, timetolive=timetolive)
 
+  def test_Peek(self):
+    now = int(time.time())
+
+    for fernet in (self.fernet, Fernet(self.key, version=VERSION_GCM)):
+      for l in (0, 1, 1000):
+        version, timestamp = Fernet.peek(fernet.encrypt(os.urandom(l)))
+        assert version == fernet._version
+        assert now <= timestamp <= time.time()
+
+    with pytest.raises(ValueError, match="12 base64 characters"):
+      Fernet.peek(base64.urlsafe_b64encode(b'\x91' + os.urandom(5)))
+
+    # The header fields are all that is needed.
+    assert Fernet.peek(base64.urlsafe_b64encode(b'\x91' + struct.pack(">Q", 42))) == (b'\x91', 42)
+
+  def test_Deterministic(self):
+    siv = Fernet(self.key, deterministic=True)
+    msg0, msg1 = os.urandom(100), os.urandom(100)
+
+    ctxe = siv.encrypt(msg0)
+    assert siv.encrypt(msg0) == ctxe
+    assert siv.encrypt(msg1) != ctxe
+    assert siv.encrypt_many([msg0, msg1, msg0]) == [ctxe, siv.encrypt(msg1), ctxe]
+    assert Fernet(Fernet.generate_key(), deterministic=True).encrypt(msg0) != ctxe
+
+    # Plain, CMAC authenticated 0x91 tokens with a fixed timestamp.
+    assert Fernet.peek(ctxe) == (b"\x91", 0)
+    assert self.fernet.decrypt(ctxe) == msg0
+    with pytest.raises(InvalidToken):
+      siv.decrypt(ctxe, timetolive=60)
+
+    # Compressed tokens of the same message get another IV.
+    zipped = Fernet(self.key, compression="zlib", deterministic=True)
+    assert zipped.encrypt(msg0) == zipped.encrypt(msg0)
+    assert base64.urlsafe_b64decode(zipped.encrypt(msg0))[9:25] != \
+           base64.urlsafe_b64decode(ctxe)[9:25]
+    assert self.fernet.decrypt(zipped.encrypt(msg0)) == msg0
+
+    with pytest.raises(ValueError):
+      Fernet(self.key, version=VERSION_GCM, deterministic=True)
+
+  def test_TokenView(self):
+    msg = os.urandom(100)
+    iv0 = os.urandom(16)
+    ctxe = self.fernet.encrypt(msg, iv0=iv0)
+    decoded = base64.urlsafe_b64decode(ctxe)
+
+    view = TokenView.decode(ctxe)
+    assert len(view) == len(decoded)
+    assert view.version == b'\x91'
+    assert view.timestamp == struct.unpack(">Q", decoded[1:9])[0]
+    assert view.timestamp_bytes.tobytes() == decoded[1:9]
+    assert view.iv.tobytes() == iv0
+    assert view.header.tobytes() == decoded[:25]
+    assert view.ciphertext.tobytes() == decoded[25:-16]
+    assert view.tag.tobytes() == decoded[-16:]
+    assert view.authenticated.tobytes() == decoded[:-16]
+    assert view.sealed.tobytes() == decoded[25:]
+
+    # The fields are views of the one buffer, nothing is copied.
+    buf = bytearray(decoded)
+    view = TokenView(buf)
+    buf[25] ^= 0xff
+    assert view.ciphertext[0] == chr(buf[25])
+
+    header = TokenView.decode_header(ctxe)
+    assert header.header.tobytes() == decoded[:25]
+    assert header.timestamp == view.timestamp
+
+    # The MAC is computed over the authenticated region in one piece.
+    calls = spy(self.fernet, "_cmac")
+    assert self.fernet.decrypt(ctxe) == msg
+    assert [len(data) for data in calls] == [1]
+
+  def test_ExpiredTimeStampFirst(self):
+    ctxe = self.fernet.encrypt(os.urandom(23))
+
+    # An expired token is rejected before its MAC is computed.
+    calls = spy(self.fernet, "_cmac")
+
+    with pytest.raises(InvalidToken):
+      self.fernet.decrypt(ctxe, timetolive=-10, ttl_first=True)
+    assert not calls
+
+    with pytest.raises(InvalidToken):
+      self.fernet.decrypt(ctxe, timetolive=-10)
+    assert len(calls) == 1
+
+    assert self.fernet.decrypt(ctxe, timetolive=60, ttl_first=True) == self.fernet.decrypt(ctxe)
+
+  def test_Replay(self):
+    guard = ReplayGuard(window=60, capacity=1000)
+    gcm = Fernet(self.key, version=VERSION_GCM)
+
+    for fernet in (self.fernet, gcm):
+      ctxe = fernet.encrypt("secret")
+      assert fernet.decrypt(ctxe, 60, replay_guard=guard) == "secret"
+
+      # A replay is rejected before it is decoded and authenticated,
+      # whatever the version.
+      calls = spy(fernet, "_decrypt")
+      with pytest.raises(InvalidToken):
+        fernet.decrypt(ctxe, 60, replay_guard=guard)
+      assert not calls
+
+    # Forged tokens are not remembered.
+    ctxe = self.fernet.encrypt("secret")
+    ctxd = base64.urlsafe_b64decode(ctxe)
+    with pytest.raises(InvalidToken):
+      self.fernet.decrypt(base64.urlsafe_b64encode(ctxd[:-1] + chr(ord(ctxd[-1]) ^ 1)),
+                          replay_guard=guard)
+    assert self.fernet.decrypt(ctxe, replay_guard=guard) == "secret"
+
   def test_EmptyMessage(self):
     msg0 = ""
     ctxe = self.fernet.encrypt(msg0)
@@ -115,6 +434,328 @@ class TestFernet:
       msg1 = self.fernet.decrypt(ctxe)
       assert msg0 == msg1
 
+  def test_Streaming(self):
+    for l in (0, 1, 2, 3, 16, 47, 48, 1000, 5000):
+      msg0 = os.urandom(l)
+
+      for chunk_size in (1, 3, 16, 64, STREAM_CHUNK_SIZE):
+        # Streamed tokens are ordinary tokens...
+        writer = io.BytesIO()
+        self.fernet.encrypt_stream(io.BytesIO(msg0), writer, chunk_size=chunk_size)
+        ctxe = writer.getvalue()
+        assert self.fernet.decrypt(ctxe) == msg0
+
+        # ...with the same ciphertext for the same IV.
+        iv = base64.urlsafe_b64decode(ctxe)[9:25]
+        assert base64.urlsafe_b64decode(ctxe)[9:-16] == \
+               base64.urlsafe_b64decode(self.fernet.encrypt(msg0, iv0=iv))[9:-16]
+
+        for unverified in (False, True):
+          writer = io.BytesIO()
+          self.fernet.decrypt_stream(io.BytesIO(self.fernet.encrypt(msg0)), writer,
+                                     unverified=unverified, chunk_size=chunk_size)
+          assert writer.getvalue() == msg0
+
+  def test_StreamingInvalidToken(self):
+    msg0 = os.urandom(1000)
+
+    ctxd = base64.urlsafe_b64decode(self.fernet.encrypt(msg0))
+    # Tamper with the message
+    ctxe = base64.urlsafe_b64encode(
+      ctxd[:-20] + chr(ord(ctxd[-20]) ^ 1) + ctxd[-19:]
+    )
+
+    # No plaintext is released from a forged token...
+    writer = io.BytesIO()
+    with pytest.raises(InvalidToken):
+      self.fernet.decrypt_stream(io.BytesIO(ctxe), writer, chunk_size=64)
+    assert writer.getvalue() == ""
+
+    # ...unless explicitly asked for.
+    writer = io.BytesIO()
+    with pytest.raises(InvalidToken):
+      self.fernet.decrypt_stream(io.BytesIO(ctxe), writer, unverified=True, chunk_size=64)
+    assert len(writer.getvalue()) == len(msg0)
+
+    with pytest.raises(InvalidToken):
+      self.fernet.decrypt_stream(io.BytesIO(base64.urlsafe_b64encode(b'\x00' + os.urandom(54))),
+                                 io.BytesIO())
+
+    with pytest.raises(ValueError):
+      self.fernet.decrypt_stream(io.BytesIO(base64.urlsafe_b64encode(b'\x91' + os.urandom(39))),
+                                 io.BytesIO())
+
+    with pytest.raises(InvalidToken):
+      self.fernet.decrypt_stream(io.BytesIO(self.fernet.encrypt(msg0)), io.BytesIO(), timetolive=-10)
+
+  def test_Batch(self):
+    msgs = [os.urandom(i % 50) for i in xrange(300)]
+
+    for pool in (None, self.fernet.worker_pool(2), self.fernet.worker_pool(2, processes=True)):
+      ctxes = self.fernet.encrypt_many(msgs, pool=pool, batch_size=64)
+      assert len(set(ctxes)) == len(msgs)
+      assert [self.fernet.decrypt(ctxe) for ctxe in ctxes] == msgs
+      assert self.fernet.decrypt_many(ctxes, pool=pool, batch_size=64) == msgs
+
+      # Errors are reported per token, in order.
+      ctxes[7] = base64.urlsafe_b64encode(b'\x00' + os.urandom(54))
+      ctxes[100] = base64.urlsafe_b64encode(b'\x00')
+      results = self.fernet.decrypt_many(ctxes, pool=pool, batch_size=64)
+      assert isinstance(results[7], InvalidToken)
+      assert isinstance(results[100], ValueError)
+      assert results[:7] + results[8:100] + results[101:] == msgs[:7] + msgs[8:100] + msgs[101:]
+
+      results = self.fernet.decrypt_many(ctxes[:5], ttl=-10, pool=pool)
+      assert all(isinstance(result, InvalidToken) for result in results)
+
+      if pool is not None:
+        pool.close()
+        pool.join()
+
+    # A pool's workers hold the key of the Fernet that created it.
+    pool = Fernet(Fernet.generate_key()).worker_pool(2)
+    with pytest.raises(ValueError):
+      self.fernet.encrypt_many(msgs, pool=pool, batch_size=64)
+    with pytest.raises(ValueError):
+      self.fernet.decrypt_many(ctxes, pool=pool, batch_size=64)
+    pool.close()
+    pool.join()
+
+  def test_DecryptRange(self):
+    for l in (0, 1, 15, 16, 17, 100, 1000):
+      msg0 = os.urandom(l)
+      ctxe = self.fernet.encrypt(msg0)
+
+      # Straight from the token, and from the token verified once.
+      for token in (ctxe, self.fernet.verify(ctxe)):
+        for offset in (0, 1, 15, 16, 17, 33, l - 1, l, l + 5):
+          for length in (0, 1, 16, 17, 40, l):
+            if offset < 0:
+              continue
+            assert self.fernet.decrypt_range(token, offset, length) == msg0[offset:offset + length]
+
+    msg0 = os.urandom(100000)
+    ctxe = self.fernet.encrypt(msg0)
+    verified = self.fernet.verify(ctxe)
+    assert isinstance(verified, VerifiedToken)
+
+    # Ranges of a verified token are neither authenticated nor decoded
+    # again, and only the blocks covering them are decrypted.
+    cmacs = spy(self.fernet, "_cmac")
+    ctrs = spy(self.fernet, "_ctr")
+    decodes = []
+    decode = TokenView.decode
+    TokenView.decode = classmethod(lambda cls, *args: decodes.append(args) or decode(*args))
+    try:
+      assert self.fernet.decrypt_range(verified, 50010, 20) == msg0[50010:50030]
+    finally:
+      TokenView.decode = decode
+    assert not cmacs and not decodes
+    assert [len(args[1]) for args in ctrs] == [30]
+
+    with pytest.raises(InvalidToken):
+      self.fernet.decrypt_range(ctxe, 0, 10, timetolive=-10)
+
+    with pytest.raises(InvalidToken):
+      self.fernet.decrypt_range(verified, 0, 10, timetolive=-10)
+
+    with pytest.raises(ValueError):
+      self.fernet.decrypt_range(ctxe, -1, 10)
+
+    # A token verified under another key is refused.
+    with pytest.raises(ValueError):
+      Fernet(Fernet.generate_key()).decrypt_range(verified, 0, 10)
+
+    # Tamper with the message
+    ctxd = base64.urlsafe_b64decode(ctxe)
+    ctxe = base64.urlsafe_b64encode(
+      ctxd[:-20] + chr(ord(ctxd[-20]) ^ 1) + ctxd[-19:]
+    )
+
+    with pytest.raises(InvalidToken):
+      self.fernet.decrypt_range(ctxe, 0, 10)
+
+    with pytest.raises(InvalidToken):
+      self.fernet.verify(ctxe)
+
+  def test_Parallel(self, monkeypatch):
+    pool = self.fernet.worker_pool(4)
+
+    # Both encryptions must share a timestamp for the tokens to match.
+    now = time.time()
+    monkeypatch.setattr(time, "time", lambda: now)
+
+    # Segments that do not line up with the 3 byte base64 groups, and a
+    # final short one.
+    monkeypatch.setattr(fernet_module, "PARALLEL_THRESHOLD", 1000)
+    monkeypatch.setattr(fernet_module, "PARALLEL_SEGMENT_SIZE", 64)
+
+    for l in (1000, 1024, 1100, 4321):
+      msg0 = os.urandom(l)
+      iv = os.urandom(16)
+
+      ctxe = self.fernet.encrypt(msg0, iv0=iv, pool=pool)
+      assert base64.urlsafe_b64decode(ctxe)[9:] == base64.urlsafe_b64decode(self.fernet.encrypt(msg0, iv0=iv))[9:]
+      assert self.fernet.decrypt(ctxe, pool=pool) == msg0
+
+      ctxd = base64.urlsafe_b64decode(ctxe)
+      # Tamper with the message
+      ctxe = base64.urlsafe_b64encode(
+        ctxd[:-20] + chr(ord(ctxd[-20]) ^ 1) + ctxd[-19:]
+      )
+      with pytest.raises(InvalidToken):
+        self.fernet.decrypt(ctxe, pool=pool)
+
+    # Encryption and decryption go parallel at the same message length.
+    for l, parallel in ((999, False), (1000, True)):
+      calls = spy(self.fernet, "_ctr_parallel")
+      ctxe = self.fernet.encrypt(os.urandom(l), pool=pool)
+      self.fernet.decrypt(ctxe, pool=pool)
+      assert len(calls) == (2 if parallel else 0)
+
+    pool.close()
+    pool.join()
+
+    pool = self.fernet.worker_pool(2, processes=True)
+    with pytest.raises(ValueError):
+      self.fernet.encrypt(os.urandom(1000), pool=pool)
+    with pytest.raises(ValueError):
+      self.fernet.decrypt(ctxe, pool=pool)
+    pool.close()
+    pool.join()
+
+  def test_IntoBuffers(self):
+    for l in (0, 1, 2, 3, 16, 100, 1000, 3 * STREAM_CHUNK_SIZE + 5):
+      msg0 = os.urandom(l)
+      size = Fernet.encrypted_size(l)
+
+      for buf in (bytearray(size), memoryview(bytearray(size + 7)), mmap.mmap(-1, size)):
+        assert self.fernet.encrypt_into(buf, msg0) == size
+        ctxe = buf[:size]
+        ctxe = ctxe.tobytes() if isinstance(ctxe, memoryview) else bytes(ctxe)
+
+        assert self.fernet.decrypt(ctxe) == msg0
+        assert all(Fernet.decrypted_size(token) == l
+                   for token in (ctxe, bytearray(ctxe), memoryview(ctxe)))
+
+        for token in (ctxe, bytearray(ctxe), memoryview(ctxe)):
+          out = bytearray(l)
+          assert self.fernet.decrypt_into(out, token) == l
+          assert out == msg0
+
+      # mmap to mmap
+      out = mmap.mmap(-1, max(l, 1))
+      assert self.fernet.decrypt_into(out, buf) == l
+      assert out[:l] == msg0
+
+    with pytest.raises(ValueError):
+      self.fernet.encrypt_into(bytearray(Fernet.encrypted_size(10) - 1), os.urandom(10))
+
+    ctxe = self.fernet.encrypt(os.urandom(10))
+    with pytest.raises(ValueError):
+      self.fernet.decrypt_into(bytearray(9), ctxe)
+
+    # Tamper with the message
+    ctxd = base64.urlsafe_b64decode(ctxe)
+    ctxe = base64.urlsafe_b64encode(
+      ctxd[:-20] + chr(ord(ctxd[-20]) ^ 1) + ctxd[-19:]
+    )
+    out = bytearray(10)
+    with pytest.raises(InvalidToken):
+      self.fernet.decrypt_into(out, ctxe)
+    assert out == base64.urlsafe_b64decode(ctxe)[25:-16]
+
+  def test_GCMVersion(self):
+    gcm = Fernet(self.key, version=VERSION_GCM)
+
+    for l in (0, 1, 16, 100, 1000):
+      msg0 = os.urandom(l)
+
+      ctxe = gcm.encrypt(msg0)
+      ctxd = base64.urlsafe_b64decode(ctxe)
+      assert ctxd[0] == VERSION_GCM
+      assert len(ctxd) == len(base64.urlsafe_b64decode(self.fernet.encrypt(msg0)))
+
+      # Either instance decrypts both versions.
+      assert gcm.decrypt(ctxe) == self.fernet.decrypt(ctxe) == msg0
+      assert gcm.decrypt(self.fernet.encrypt(msg0)) == msg0
+
+    # Compare against `cryptography`: AES-256-GCM under a key derived from
+    # the signing key, the header as associated data.
+    iv = os.urandom(16)
+    ctxd = base64.urlsafe_b64decode(gcm.encrypt("this is a super secret message", iv0=iv))
+    signer = cmac.CMAC(ciphers.algorithms.AES(base64.urlsafe_b64decode(self.key)[:16]), self._backend)
+    gcm_key = b""
+    for label in (b"Fernet GCM key 1", b"Fernet GCM key 2"):
+      c = signer.copy()
+      c.update(label)
+      gcm_key += c.finalize()
+    aead = AESGCM(gcm_key)
+    assert aead.decrypt(iv, ctxd[25:], ctxd[:25]) == "this is a super secret message"
+
+    # The whole Fernet key is not the GCM key.
+    with pytest.raises(InvalidTag):
+      AESGCM(base64.urlsafe_b64decode(self.key)).decrypt(iv, ctxd[25:], ctxd[:25])
+
+    assert gcm.encrypt_many(["a", "b"]) != self.fernet.encrypt_many(["a", "b"])
+    assert self.fernet.decrypt_many(gcm.encrypt_many(["a", "b"])) == ["a", "b"]
+
+    # Tamper with the header, the message and the tag
+    ctxe = gcm.encrypt(os.urandom(23))
+    ctxd = base64.urlsafe_b64decode(ctxe)
+    for i in (5, 30, len(ctxd) - 1):
+      with pytest.raises(InvalidToken):
+        gcm.decrypt(base64.urlsafe_b64encode(ctxd[:i] + chr(ord(ctxd[i]) ^ 1) + ctxd[i + 1:]))
+
+    with pytest.raises(InvalidToken):
+      gcm.decrypt(ctxe, timetolive=-10)
+
+    with pytest.raises(ValueError):
+      gcm.decrypt(base64.urlsafe_b64encode(VERSION_GCM + os.urandom(39)))
+
+    with pytest.raises(ValueError):
+      Fernet(self.key, version=b"\x93")
+
+  def test_Compression(self):
+    zipped = Fernet(self.key, compression="zlib")
+    msg0 = b'{"level": "info", "message": "request served"}\n' * 100
+
+    ctxe = zipped.encrypt(msg0)
+    ctxd = base64.urlsafe_b64decode(ctxe)
+    assert ctxd[0] == VERSION_COMPRESSED
+    assert ctxd[25] == CODECS["zlib"][0]
+    assert len(ctxe) < len(self.fernet.encrypt(msg0)) // 10
+
+    # Either instance decrypts compressed and plain tokens.
+    assert self.fernet.decrypt(ctxe) == zipped.decrypt(ctxe) == msg0
+    assert zipped.decrypt(self.fernet.encrypt(msg0)) == msg0
+    assert self.fernet.decrypt_many(zipped.encrypt_many([b"", msg0])) == [b"", msg0]
+
+    # Tamper with the header, the codec, the message and the tag
+    for i in (5, 25, 30, len(ctxd) - 1):
+      with pytest.raises(InvalidToken):
+        zipped.decrypt(base64.urlsafe_b64encode(ctxd[:i] + chr(ord(ctxd[i]) ^ 1) + ctxd[i + 1:]))
+
+    with pytest.raises(InvalidToken):
+      zipped.decrypt(ctxe, timetolive=-10)
+
+    with pytest.raises(ValueError):
+      zipped.decrypt(base64.urlsafe_b64encode(VERSION_COMPRESSED + os.urandom(40)))
+
+    with pytest.raises(ValueError):
+      Fernet(self.key, compression="nope")
+
+    # Codecs are pluggable, and their ids must not clash.
+    register_codec("reversed", b"\xfe", lambda m: m[::-1], lambda m: m[::-1])
+    try:
+      assert Fernet(self.key, compression="reversed").decrypt(
+        Fernet(self.key, compression="reversed").encrypt(msg0)) == msg0
+
+      with pytest.raises(ValueError):
+        register_codec("other", b"\xfe", zlib.compress, zlib.decompress)
+    finally:
+      del CODECS["reversed"]
+
   def test_EncryptionCorrectness(self):
 
     encryption_key = self.fernet._encryption_key
@@ -250,6 +891,36 @@ class TestFernet:
                                                       self._backend),
                          iv=iv)
 
+  def test_CounterBlocks(self):
+
+    encryption_key = self.fernet._encryption_key
+
+    def _reference_ctr(iv0, data):
+      """ One ECB evaluation per counter block, as the keystream is defined. """
+      ivn = num(iv0)
+      out = ""
+      for i in xrange(0, len(data), 16):
+        cipher = ciphers.Cipher(ciphers.algorithms.AES(encryption_key),
+                                ciphers.modes.ECB(),
+                                self._backend)
+        encryptor = cipher.encryptor()
+        pad = encryptor.update(byteblock(ivn + i // 16)) + encryptor.finalize()
+        out += "".join(chr(ord(m) ^ ord(p)) for m, p in zip(data[i:i + 16], pad))
+      return out
+
+    # The counter carries across the 64 bit boundary and wraps at 2^128.
+    for iv in (os.urandom(16), 8 * '\x00' + 8 * '\xff', 16 * '\xff'):
+      for l in (0, 1, 15, 16, 17, 100):
+        msg0 = os.urandom(l)
+        assert self.fernet._ctr(iv, msg0) == _reference_ctr(iv, msg0)
+
+    # Any block-aligned segment can be produced from its offset alone.
+    iv = os.urandom(16)
+    msg0 = os.urandom(200)
+    ctx = self.fernet._ctr(iv, msg0)
+    for k in xrange(0, 13):
+      assert self.fernet._ctr(iv, msg0[16 * k:], block_offset=k) == ctx[16 * k:]
+
   def test_AuthenticationCorrectness(self):
 
     signing_key = self.fernet._signing_key
@@ -275,6 +946,53 @@ class TestFernet:
 
       assert hazmat_tag == fernet_tag
 
+  def test_CMACTestVectors(self):
+
+    # Verify the AES-CMAC test vectors from RFC 4493 section 4, on both the
+    # CBC-MAC engine and the `cryptography` backed one.
+    signing_key = binascii.unhexlify("2b7e151628aed2a6abf7158809cf4f3c")
+
+    msg = "".join(map(binascii.unhexlify, [
+      "6bc1bee22e409f96e93d7e117393172a",
+      "ae2d8a571e03ac9c9eb76fac45af8e51",
+      "30c81c46a35ce411e5fbc1191a0a52ef",
+      "f69f2445df4f9b17ad2b417be66c3710"
+    ]))
+
+    vectors = [
+      (0, "bb1d6929e95937287fa37d129b756746"),
+      (16, "070a16b46b4d4144f79bdd9dd04a287c"),
+      (40, "dfa66747de9ae63030ca32611497c827"),
+      (64, "51f0bebf7e3b9d92fc49741779363cfe"),
+    ]
+
+    engine = AESCMAC(signing_key, self._backend)
+    native_engine = AESCMAC(signing_key, self._backend, native=True)
+
+    assert engine._k1 == binascii.unhexlify("fbeed618357133667c85e08f7236a8de")
+    assert engine._k2 == binascii.unhexlify("f7ddac306ae266ccf90bc11ee46d513b")
+
+    for length, expected in vectors:
+      expected = binascii.unhexlify(expected)
+
+      data = msg[:length]
+
+      assert engine.tag(data) == native_engine.tag(data) == expected
+
+      # Feeding the message in pieces gives the same tag.
+      for step in (1, 7, 16, 17):
+        for e in (engine, native_engine):
+          ctx = e.context()
+          for i in xrange(0, length, step):
+            ctx.update(data[i:i + step])
+          assert ctx.finalize() == expected
+
+    # Both engines are interchangeable within Fernet.
+    native = Fernet(self.key, native_cmac=True)
+    msg0 = os.urandom(100)
+    assert native.decrypt(self.fernet.encrypt(msg0)) == msg0
+    assert self.fernet.decrypt(native.encrypt(msg0)) == msg0
+
   def test_DecryptionCorrectness(self):
 
     encryption_key = self.fernet._encryption_key
@@ -309,6 +1027,7 @@ if __name__ == "__main__":
   # Helpers
   test_num()
   test_byteblock()
+  test_base64_codec()
 
   # Crypto
   a = TestFernet()
@@ -317,9 +1036,23 @@ if __name__ == "__main__":
   a.test_ShortCipherText()
   a.test_InvalidMac()
   a.test_ExpiredTimeStamp()
+  a.test_Peek()
+  a.test_TokenView()
+  a.test_Deterministic()
+  a.test_ExpiredTimeStampFirst()
+  a.test_Replay()
   a.test_EmptyMessage()
   # Functionality & Correctness:
   a.test_Functionality()
+  a.test_Streaming()
+  a.test_StreamingInvalidToken()
+  a.test_Batch()
+  a.test_DecryptRange()
+  a.test_IntoBuffers()
+  a.test_GCMVersion()
+  a.test_Compression()
   a.test_EncryptionCorrectness()
+  a.test_CounterBlocks()
   a.test_AuthenticationCorrectness()
+  a.test_CMACTestVectors()
   a.test_DecryptionCorrectness()
@@ -1,4 +1,8 @@
-import Feistel
+import struct
+
+import numpy as np
+
+from feistel_ciphers.Feistel import Feistel, MAX_CC_NUM
 
 
 class CreditCardFeistel(Feistel):
@@ -93,8 +97,143 @@ class CreditCardFeistel(Feistel):
         while plain_num > MAX_CC_NUM:
             plain_num = self.bytes_to_num(
                 reduce(lambda d, i: self._feistel_round_dec(i, d),
-                       range(self._num_rounds),
+                       range(self._num_rounds - 1, -1, -1),
                        cipher_bytes))
             cipher_bytes = self.num_to_bytes(plain_num)
 
         return plain_num
+
+    def encrypt_batch(self, numbers):
+        """
+        `encrypt` every number of `numbers`, returning a uint64 array. Each
+        pass runs all the values that are still cycle-walking through the
+        network at once (see `Feistel.encrypt_batch`), and only those that
+        came out above MAX_CC_NUM go on to the next pass.
+        """
+        return self._cycle_walk_batch(numbers, range(self._num_rounds), decrypt=False)
+
+    def decrypt_batch(self, ctxs):
+        """ `decrypt` every number of `ctxs`, see `encrypt_batch`. """
+        return self._cycle_walk_batch(ctxs, range(self._num_rounds - 1, -1, -1), decrypt=True)
+
+    def _cycle_walk_batch(self, numbers, round_indices, decrypt):
+        numbers = np.array(numbers, dtype=np.uint64)
+        assert (numbers <= MAX_CC_NUM).all()
+
+        walking = np.arange(len(numbers))
+        while len(walking):
+            # The 7 low bytes of each number, least significant first, as
+            # `num_to_bytes` lays them out.
+            blocks = numbers[walking].astype('<u8').view(np.uint8).reshape(-1, 8)[:, :7]
+            blocks = self._feistel_rounds_batch(blocks, round_indices, decrypt)
+
+            values = np.zeros((len(walking), 8), dtype=np.uint8)
+            values[:, :7] = blocks
+            values = values.view('<u8').ravel()
+
+            numbers[walking] = values
+            walking = walking[values > MAX_CC_NUM]
+
+        return numbers
+
+    def _feistel_rounds_batch(self, blocks, round_indices, decrypt):
+        """
+        `_feistel_round_enc` (or `_feistel_round_dec`) rounds on every row of
+        the (N, 7) uint8 array `blocks`, one bulk PRF evaluation per round.
+        """
+        prf_input = np.zeros((len(blocks), 16), dtype=np.uint8)
+
+        for round_index in round_indices:
+            prf_input[:, 12] = round_index
+
+            if decrypt:
+                prf_input[:, 13:] = blocks[:, 4:]
+                round_pad = self._prf_batch(self._round_keys[round_index], prf_input)
+                blocks = np.concatenate((blocks[:, 4:], blocks[:, :4] ^ round_pad[:, :4]), axis=1)
+            else:
+                prf_input[:, 13:] = blocks[:, :3]
+                round_pad = self._prf_batch(self._round_keys[round_index], prf_input)
+                blocks = np.concatenate((blocks[:, 3:] ^ round_pad[:, :4], blocks[:, :3]), axis=1)
+
+        return blocks
+
+
+# Each half of a 16 digit number holds 8 digits.
+HALF_MODULUS = 10 ** 8
+
+
+class RadixCreditCardFeistel(Feistel):
+    """
+      A Feistel network over the decimal digits themselves, in the style of
+      FF1/FF3: a 16 digit number is split into two 8 digit halves A || B,
+      and each round combines them with addition mod 10^8,
+
+            A || B  ->  B || (A + F(i, B)) mod 10^8
+
+      ... where F(i, B) is the AES PRF of the round index and B, read as a
+      64 bit number, reduced mod 10^8. Every value of the network is
+      already a 16 digit number, so unlike `CreditCardFeistel` there is no
+      cycle-walking: an encryption is exactly one pass of `num_rounds`.
+
+      The two classes produce different tokens; tokens of one can only be
+      decrypted by the same class.
+    """
+
+    def _round_function(self, round_index, half):
+        round_pad = self._prf(self._round_keys[round_index], chr(round_index) + struct.pack(">I", half))
+
+        return struct.unpack(">Q", round_pad[:8])[0] % HALF_MODULUS
+
+    def encrypt(self, data):
+        assert 0 <= data <= MAX_CC_NUM
+
+        a, b = divmod(data, HALF_MODULUS)
+        for i in range(self._num_rounds):
+            a, b = b, (a + self._round_function(i, b)) % HALF_MODULUS
+
+        return a * HALF_MODULUS + b
+
+    def decrypt(self, ctx):
+        assert 0 <= ctx <= MAX_CC_NUM
+
+        a, b = divmod(ctx, HALF_MODULUS)
+        for i in range(self._num_rounds - 1, -1, -1):
+            a, b = (b - self._round_function(i, a)) % HALF_MODULUS, a
+
+        return a * HALF_MODULUS + b
+
+    def encrypt_batch(self, numbers):
+        """
+        `encrypt` every number of `numbers`, returning a uint64 array, with
+        one bulk PRF evaluation per round.
+        """
+        return self._rounds_batch(numbers, range(self._num_rounds), decrypt=False)
+
+    def decrypt_batch(self, ctxs):
+        """ `decrypt` every number of `ctxs`, see `encrypt_batch`. """
+        return self._rounds_batch(ctxs, range(self._num_rounds - 1, -1, -1), decrypt=True)
+
+    def _rounds_batch(self, numbers, round_indices, decrypt):
+        numbers = np.array(numbers, dtype=np.uint64)
+        assert (numbers <= MAX_CC_NUM).all()
+
+        a, b = np.divmod(numbers, np.uint64(HALF_MODULUS))
+
+        # Zero padding || round index || the half as 4 big-endian bytes, as
+        # `_round_function` pads it.
+        prf_input = np.zeros((len(numbers), 16), dtype=np.uint8)
+
+        for round_index in round_indices:
+            half = a if decrypt else b
+
+            prf_input[:, 11] = round_index
+            prf_input[:, 12:] = half.astype('>u4').view(np.uint8).reshape(-1, 4)
+            round_pad = self._prf_batch(self._round_keys[round_index], prf_input)
+            f = round_pad[:, :8].copy().view('>u8').ravel().astype(np.uint64) % np.uint64(HALF_MODULUS)
+
+            if decrypt:
+                a, b = (b + np.uint64(HALF_MODULUS) - f) % np.uint64(HALF_MODULUS), a
+            else:
+                a, b = b, (a + f) % np.uint64(HALF_MODULUS)
+
+        return a * np.uint64(HALF_MODULUS) + b
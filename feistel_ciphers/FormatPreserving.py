@@ -0,0 +1,238 @@
+import string
+import struct
+
+import numpy as np
+
+from feistel_ciphers.Feistel import Feistel
+
+# The placeholders of a format mask; any other character is a literal, as is
+# one escaped with a backslash.
+MASK_ALPHABETS = {
+  'd': string.digits,
+  'a': string.ascii_lowercase,
+  'A': string.ascii_uppercase,
+  'x': string.digits + string.ascii_lowercase,
+  'X': string.digits + string.ascii_uppercase,
+}
+
+
+class FormatSpec(object):
+  """
+  A fixed length format: the alphabet each position draws from. It is
+  either a mask such as 'ddd-dd-dddd' (see MASK_ALPHABETS) or a list of
+  alphabets, one string per position; a one character alphabet is a
+  literal.
+
+  Values are numbered in mixed radix, the last position varying fastest.
+  `rank` maps a value to its number in [0, size) and `unrank` back, through
+  tables computed once per spec.
+  """
+
+  def __init__(self, spec):
+    if isinstance(spec, basestring):
+      spec = self._parse_mask(spec)
+
+    self.alphabets = [alphabet for alphabet in spec]
+    if not all(self.alphabets):
+      raise ValueError("Every position needs at least one character.")
+
+    for alphabet in self.alphabets:
+      if len(set(alphabet)) != len(alphabet):
+        raise ValueError("Repeated character in alphabet {!r}".format(alphabet))
+
+    # The positions that are not literals, their ranks per character, and
+    # the weight of each in the mixed radix number.
+    self._positions = [i for i, alphabet in enumerate(self.alphabets) if len(alphabet) > 1]
+    self._ranks = [dict((c, r) for r, c in enumerate(alphabet)) for alphabet in self.alphabets]
+
+    self._weights = []
+    self.size = 1
+    for i in reversed(self._positions):
+      self._weights.insert(0, self.size)
+      self.size *= len(self.alphabets[i])
+
+  @classmethod
+  def _parse_mask(cls, mask):
+    alphabets = []
+    escaped = False
+    for c in mask:
+      if escaped or c not in MASK_ALPHABETS and c != '\\':
+        alphabets.append(c)
+        escaped = False
+      elif c == '\\':
+        escaped = True
+      else:
+        alphabets.append(MASK_ALPHABETS[c])
+
+    if escaped:
+      raise ValueError("Mask ends with an escape: {!r}".format(mask))
+
+    return alphabets
+
+  def __len__(self):
+    return len(self.alphabets)
+
+  def rank(self, value):
+    if len(value) != len(self.alphabets):
+      raise ValueError("{!r} is not {} characters long.".format(value, len(self.alphabets)))
+
+    num = 0
+    for i, ranks in enumerate(self._ranks):
+      if value[i] not in ranks:
+        raise ValueError("{!r} does not match the format at position {}.".format(value, i))
+
+    for i, weight in zip(self._positions, self._weights):
+      num += self._ranks[i][value[i]] * weight
+
+    return num
+
+  def unrank(self, num):
+    assert 0 <= num < self.size
+
+    value = [alphabet[0] for alphabet in self.alphabets]
+    for i, weight in zip(self._positions, self._weights):
+      r, num = divmod(num, weight)
+      value[i] = self.alphabets[i][r]
+
+    return ''.join(value)
+
+
+class FormatPreservingCipher(Feistel):
+  """
+    Encrypts values of a `FormatSpec` to values of the same format, e.g.
+    SSNs to SSNs, keeping the literal characters in place.
+
+    A value is ranked to a number below the size D of the format, which
+    is encrypted with an alternating Feistel network on the n bits of the
+    smallest power of two not below D: the halves A (ceil(n / 2) bits) and
+    B (floor(n / 2) bits) go
+
+            A || B  ->  B || A xor F(i, n, B)
+
+    ... F being the AES PRF truncated to the width of A. Results of D or
+    more are encrypted again (cycle-walking, see `CreditCardFeistel`);
+    since 2^n < 2D that takes fewer than 2 passes on average.
+  """
+
+  def __init__(self, key, spec, num_rounds=10, backend=None):
+    Feistel.__init__(self, key, num_rounds, backend)
+
+    self.spec = spec if isinstance(spec, FormatSpec) else FormatSpec(spec)
+    self._bits = max((self.spec.size - 1).bit_length(), 2)
+    self._half_bytes = ((self._bits + 1) / 2 + 7) / 8
+
+  def _round_function(self, round_index, half, width):
+    round_pad = self._prf(self._round_keys[round_index],
+                          struct.pack(">BH", round_index, self._bits) + self._half_to_bytes(half))
+
+    return int(round_pad[:self._half_bytes].encode('hex'), 16) & ((1 << width) - 1)
+
+  def _half_to_bytes(self, half):
+    return ('%0*x' % (2 * self._half_bytes, half)).decode('hex')
+
+  def _widths(self, round_index):
+    """ The widths of the halves (A, B) going into round `round_index`. """
+    wide, narrow = (self._bits + 1) / 2, self._bits / 2
+
+    return (wide, narrow) if round_index % 2 == 0 else (narrow, wide)
+
+  def _encrypt_num(self, num):
+    while True:
+      a_width, b_width = self._widths(0)
+      a, b = num >> b_width, num & ((1 << b_width) - 1)
+
+      for i in xrange(self._num_rounds):
+        a_width, b_width = self._widths(i)
+        a, b = b, a ^ self._round_function(i, b, a_width)
+
+      num = (a << self._widths(self._num_rounds)[1]) | b
+      if num < self.spec.size:
+        return num
+
+  def _decrypt_num(self, num):
+    while True:
+      a_width, b_width = self._widths(self._num_rounds)
+      a, b = num >> b_width, num & ((1 << b_width) - 1)
+
+      for i in xrange(self._num_rounds - 1, -1, -1):
+        a_width, b_width = self._widths(i)
+        a, b = b ^ self._round_function(i, a, a_width), a
+
+      num = (a << self._widths(0)[1]) | b
+      if num < self.spec.size:
+        return num
+
+  def encrypt(self, data):
+    return self.spec.unrank(self._encrypt_num(self.spec.rank(data)))
+
+  def decrypt(self, ctx):
+    return self.spec.unrank(self._decrypt_num(self.spec.rank(ctx)))
+
+  def encrypt_batch(self, values):
+    """
+    `encrypt` every value of `values`, returning a list. Formats of up to
+    64 bits are cycle-walked in bulk as in `CreditCardFeistel.encrypt_batch`,
+    with one PRF evaluation per round for all the values still walking.
+    """
+    return self._batch(values, decrypt=False)
+
+  def decrypt_batch(self, ctxs):
+    """ `decrypt` every value of `ctxs`, see `encrypt_batch`. """
+    return self._batch(ctxs, decrypt=True)
+
+  def _batch(self, values, decrypt):
+    nums = [self.spec.rank(value) for value in values]
+
+    if self._bits > 64:
+      walk = self._decrypt_num if decrypt else self._encrypt_num
+      nums = [walk(num) for num in nums]
+    else:
+      nums = self._cycle_walk_batch(np.array(nums, dtype=np.uint64), decrypt)
+
+    return [self.spec.unrank(int(num)) for num in nums]
+
+  def _cycle_walk_batch(self, nums, decrypt):
+    walking = np.arange(len(nums))
+    while len(walking):
+      values = self._rounds_batch(nums[walking], decrypt)
+
+      nums[walking] = values
+      walking = walking[values >= self.spec.size]
+
+    return nums
+
+  def _rounds_batch(self, nums, decrypt):
+    if decrypt:
+      round_indices = xrange(self._num_rounds - 1, -1, -1)
+      first, last = self._num_rounds, 0
+    else:
+      round_indices = xrange(self._num_rounds)
+      first, last = 0, self._num_rounds
+
+    b_width = np.uint64(self._widths(first)[1])
+    a, b = nums >> b_width, nums & ((np.uint64(1) << b_width) - np.uint64(1))
+
+    # Zero padding || round index || n || the half, as `_round_function`
+    # pads it (at most 3 + 4 bytes, so a single block).
+    prf_input = np.zeros((len(nums), 16), dtype=np.uint8)
+    at = 16 - 3 - self._half_bytes
+    prf_input[:, at + 1:at + 3] = np.array([self._bits], dtype='>u2').view(np.uint8)
+
+    for i in round_indices:
+      a_width = self._widths(i)[0]
+      half = a if decrypt else b
+
+      prf_input[:, at] = i
+      prf_input[:, at + 3:] = half.astype('>u4').view(np.uint8).reshape(-1, 4)[:, 4 - self._half_bytes:]
+      round_pad = self._prf_batch(self._round_keys[i], prf_input)
+
+      f = np.zeros((len(nums), 8), dtype=np.uint8)
+      f[:, 8 - self._half_bytes:] = round_pad[:, :self._half_bytes]
+      f = f.view('>u8').ravel().astype(np.uint64) & np.uint64((1 << a_width) - 1)
+
+      if decrypt:
+        a, b = b ^ f, a
+      else:
+        a, b = b, a ^ f
+
+    return (a << np.uint64(self._widths(last)[1])) | b
@@ -0,0 +1,204 @@
+import mmap
+import os
+from multiprocessing import Pool
+
+import numpy as np
+
+from feistel_ciphers.Feistel import LengthPreservingCipher
+
+# Records a worker encrypts (and the checkpoint records) at a time.
+CHUNK_RECORDS = 64 * 1024
+
+
+def encrypt_file(path, key, record_size, field, workers=None, checkpoint=None,
+                 chunk_records=CHUNK_RECORDS, tables=None):
+  """
+  Encrypt, in place, bytes [start, stop) = `field` of every `record_size`
+  byte record of the file at `path` with a `LengthPreservingCipher`.
+
+  The file is memory-mapped by a pool of `workers` processes, each
+  encrypting chunks of `chunk_records` records with
+  `LengthPreservingCipher.encrypt_batch` straight in the mapping, so no
+  record is ever copied into a string. `tables` are passed on to the
+  ciphers (see `LengthPreservingCipher.load_tables`).
+
+  Encryption in place can not simply be repeated, so with a `checkpoint`
+  path every chunk is first written to a redo file next to it, then to the
+  mapping, and only then recorded as done. A run interrupted at any point
+  resumes from the checkpoint: chunks with a redo file are rewritten from
+  it, chunks without one are encrypted afresh.
+
+  :return: the number of chunks processed by this run
+  """
+  return _process_file(path, key, record_size, field, workers, checkpoint,
+                       chunk_records, tables, decrypt=False)
+
+
+def decrypt_file(path, key, record_size, field, workers=None, checkpoint=None,
+                 chunk_records=CHUNK_RECORDS, tables=None):
+  """ Decrypt a file encrypted by `encrypt_file`, in place, in the same way. """
+  return _process_file(path, key, record_size, field, workers, checkpoint,
+                       chunk_records, tables, decrypt=True)
+
+
+def _process_file(path, key, record_size, field, workers, checkpoint, chunk_records,
+                  tables, decrypt):
+  start, stop = field
+  if not 0 <= start <= stop <= record_size:
+    raise ValueError("Field {} is not within {} byte records.".format(field, record_size))
+
+  # The Feistel network is balanced, so it only takes an even number of bytes.
+  if (stop - start) % 2:
+    raise ValueError("Field {} is {} bytes wide, not an even number.".format(field, stop - start))
+
+  size = os.path.getsize(path)
+  if size % record_size:
+    raise ValueError("{} is not made of {} byte records.".format(path, record_size))
+
+  num_records = size // record_size
+  chunks = range(-(-num_records // chunk_records))
+
+  done = set()
+  if checkpoint is not None:
+    params = "{} {} {} {} {}".format(record_size, start, stop, chunk_records,
+                                     "decrypt" if decrypt else "encrypt")
+    done = _resume(path, checkpoint, params, record_size, chunk_records)
+
+  pending = [chunk for chunk in chunks if chunk not in done]
+  if not pending or stop == start:
+    return 0
+
+  pool = Pool(workers, _init_worker,
+              (path, key, record_size, field, chunk_records, checkpoint, tables, decrypt))
+  try:
+    for chunk in pool.imap_unordered(_process_chunk, pending):
+      if checkpoint is not None:
+        _mark_done(checkpoint, chunk)
+  finally:
+    pool.close()
+    pool.join()
+
+  return len(pending)
+
+
+def _redo_path(checkpoint, chunk):
+  return "{}.{}.redo".format(checkpoint, chunk)
+
+
+def _resume(path, checkpoint, params, record_size, chunk_records):
+  """
+  Read the chunks a checkpoint records as done, after rewriting (and
+  recording) the chunks that have a redo file but were not recorded yet.
+  """
+  if not os.path.exists(checkpoint):
+    with open(checkpoint, "w") as f:
+      f.write(params + "\n")
+      f.flush()
+      os.fsync(f.fileno())
+
+    return set()
+
+  with open(checkpoint) as f:
+    lines = f.read().splitlines()
+
+  if not lines or lines[0] != params:
+    raise ValueError("{} is the checkpoint of another run.".format(checkpoint))
+
+  done = set(int(line) for line in lines[1:] if line)
+
+  directory = os.path.dirname(os.path.abspath(checkpoint))
+  prefix = os.path.basename(checkpoint) + "."
+  for name in os.listdir(directory):
+    if not name.startswith(prefix):
+      continue
+
+    # A redo file that was never completed, its chunk was left untouched.
+    if name.endswith(".redo.tmp"):
+      os.remove(os.path.join(directory, name))
+      continue
+
+    if not name.endswith(".redo"):
+      continue
+
+    chunk = int(name[len(prefix):-len(".redo")])
+    redo = os.path.join(directory, name)
+    if chunk in done:
+      os.remove(redo)
+      continue
+
+    # Written to the redo file, and maybe (partly) to the mapping.
+    with open(redo, "rb") as f:
+      records = f.read()
+
+    with open(path, "r+b") as f:
+      mm = mmap.mmap(f.fileno(), 0)
+      offset = chunk * chunk_records * record_size
+      mm[offset:offset + len(records)] = records
+      mm.flush()
+      mm.close()
+
+    _mark_done(checkpoint, chunk)
+    done.add(chunk)
+
+  return done
+
+
+def _mark_done(checkpoint, chunk):
+  with open(checkpoint, "a") as f:
+    f.write("{}\n".format(chunk))
+    f.flush()
+    os.fsync(f.fileno())
+
+  redo = _redo_path(checkpoint, chunk)
+  if os.path.exists(redo):
+    os.remove(redo)
+
+
+# The mapping, cipher and parameters of a pool worker process.
+_worker = {}
+
+
+def _init_worker(path, key, record_size, field, chunk_records, checkpoint, tables, decrypt):
+  f = open(path, "r+b")
+  _worker.update(file=f, mmap=mmap.mmap(f.fileno(), 0),
+                 cipher=LengthPreservingCipher(key, field[1] - field[0], tables=tables),
+                 record_size=record_size, field=field, chunk_records=chunk_records,
+                 checkpoint=checkpoint, decrypt=decrypt)
+
+
+def _process_chunk(chunk):
+  mm, cipher = _worker["mmap"], _worker["cipher"]
+  record_size, chunk_records = _worker["record_size"], _worker["chunk_records"]
+  start, stop = _worker["field"]
+
+  first = chunk * chunk_records
+  count = min(chunk_records, len(mm) // record_size - first)
+  offset = first * record_size
+
+  records = np.frombuffer(mm, dtype=np.uint8, count=count * record_size,
+                          offset=offset).reshape(count, record_size)
+
+  if _worker["decrypt"]:
+    fields = cipher.decrypt_batch(records[:, start:stop])
+  else:
+    fields = cipher.encrypt_batch(records[:, start:stop])
+
+  if _worker["checkpoint"] is not None:
+    # Whole records, so the redo file can be written back as one range.
+    updated = records.copy()
+    updated[:, start:stop] = fields
+
+    redo = _redo_path(_worker["checkpoint"], chunk)
+    with open(redo + ".tmp", "wb") as f:
+      f.write(updated.tobytes())
+      f.flush()
+      os.fsync(f.fileno())
+    os.rename(redo + ".tmp", redo)
+
+  records[:, start:stop] = fields
+
+  # msync wants a page aligned offset.
+  aligned = offset - offset % mmap.ALLOCATIONGRANULARITY
+  mm.flush(aligned, offset + count * record_size - aligned)
+
+  return chunk
@@ -0,0 +1,222 @@
+"""
+Tokenize columns of card numbers in CSV or newline delimited JSON with
+`CreditCardFeistel`, streaming from input to output:
+
+  python -m feistel_ciphers.Tokenize --key KEY --columns pan < in.csv > out.csv
+
+Rows are read in batches that a pool of worker processes, each with its own
+cipher, tokenize with `CreditCardFeistel.encrypt_batch`. Batches are written
+in input order, and no more than `--max-pending` of them are in flight, so
+memory stays bounded however large the input. Progress goes to stderr.
+"""
+import argparse
+import collections
+import csv
+import json
+import sys
+import time
+from multiprocessing import Pool, cpu_count
+
+from feistel_ciphers.CreditCard import CreditCardFeistel
+
+# Rows per batch handed to a worker.
+BATCH_SIZE = 4096
+
+# Batches read ahead of the one being written, per worker.
+PENDING_PER_WORKER = 4
+
+# Seconds between progress reports.
+REPORT_INTERVAL = 5
+
+FORMATS = ("csv", "ndjson")
+
+
+def tokenize_stream(reader, writer, key, columns, fmt="csv", decrypt=False, workers=None,
+                    batch_size=BATCH_SIZE, max_pending=None, rounds=10, progress=None,
+                    report_interval=REPORT_INTERVAL):
+  """
+  Tokenize (or, with `decrypt`, detokenize) the `columns` of every row read
+  from the file-like `reader`, writing the rows to `writer`.
+
+  A CSV input starts with a header row naming the columns; the values of
+  newline delimited JSON are looked up by key. Values must be numbers of
+  at most 16 digits, and come out as 16 digit tokens (a CSV value or JSON
+  string) with the leading zeros. Empty values are left as they are.
+
+  :param progress: a file to report rows/sec to, every `report_interval` seconds
+  :return: the number of rows processed
+  """
+  if fmt not in FORMATS:
+    raise ValueError("Unknown format: {}".format(fmt))
+
+  workers = workers or cpu_count()
+  if max_pending is None:
+    max_pending = PENDING_PER_WORKER * workers
+
+  pool = Pool(workers, _init_worker, (key, rounds))
+  meter = _RowMeter(progress, report_interval)
+  try:
+    if fmt == "csv":
+      rows = csv.reader(reader)
+      header = next(rows, None)
+      if header is None:
+        return 0
+
+      missing = [column for column in columns if column not in header]
+      if missing:
+        raise ValueError("No such columns: {}".format(", ".join(missing)))
+
+      out = csv.writer(writer, lineterminator="\n")
+      out.writerow(header)
+
+      work = (("csv", [header.index(column) for column in columns], first, batch, decrypt)
+              for first, batch in _batches(rows, batch_size))
+      write = out.writerows
+    else:
+      lines = (line for line in reader if line.strip())
+      work = (("ndjson", columns, first, batch, decrypt)
+              for first, batch in _batches(lines, batch_size))
+      write = writer.writelines
+
+    # Results in input order: wait for the oldest batch once `max_pending`
+    # are in flight, so reading never runs ahead of writing.
+    pending = collections.deque()
+    for item in work:
+      pending.append(pool.apply_async(_tokenize_batch, (item,)))
+
+      while len(pending) >= max_pending:
+        meter.add(_write(write, pending.popleft()))
+
+    while pending:
+      meter.add(_write(write, pending.popleft()))
+  except BaseException:
+    pool.terminate()
+    raise
+  finally:
+    pool.close()
+    pool.join()
+
+  meter.report(final=True)
+
+  return meter.rows
+
+
+def _batches(rows, batch_size):
+  """ Batches of `rows`, with the number (from 1) of the first row of each. """
+  first, batch = 1, []
+  for row in rows:
+    batch.append(row)
+    if len(batch) == batch_size:
+      yield first, batch
+      first, batch = first + batch_size, []
+
+  if batch:
+    yield first, batch
+
+
+def _write(write, result):
+  rows = result.get()
+  write(rows)
+
+  return len(rows)
+
+
+class _RowMeter(object):
+  """ Counts rows, and reports rows/sec to `out` every `interval` seconds. """
+
+  def __init__(self, out, interval):
+    self.rows = 0
+    self._out = out
+    self._interval = interval
+    self._start = self._last = time.time()
+
+  def add(self, rows):
+    self.rows += rows
+    if self._out is not None and time.time() - self._last >= self._interval:
+      self.report()
+
+  def report(self, final=False):
+    if self._out is None:
+      return
+
+    self._last = time.time()
+    elapsed = max(self._last - self._start, 1e-6)
+    self._out.write("{}{} rows, {:.0f} rows/sec\n".format("done: " if final else "",
+                                                          self.rows, self.rows / elapsed))
+    self._out.flush()
+
+
+# The cipher of a pool worker process.
+_worker = {}
+
+
+def _init_worker(key, rounds):
+  _worker["cipher"] = CreditCardFeistel(key, rounds)
+
+
+def _tokenize_batch(work):
+  fmt, columns, first, batch, decrypt = work
+
+  if fmt == "csv":
+    rows = batch
+    width = max(columns) + 1
+    for i, row in enumerate(rows):
+      if len(row) < width:
+        raise ValueError("Row {} has {} fields, fewer than the header.".format(first + i, len(row)))
+    get = lambda row, column: row[column]
+  else:
+    # Ordered, so only the tokenized values of a row change.
+    rows = [json.loads(line, object_pairs_hook=collections.OrderedDict) for line in batch]
+    get = lambda row, column: row.get(column, "")
+
+  for column in columns:
+    values = [get(row, column) for row in rows]
+    filled = [i for i, value in enumerate(values) if value not in ("", None)]
+
+    nums = []
+    for i in filled:
+      value = str(values[i])
+      if not value.isdigit() or len(value) > 16:
+        raise ValueError("Row {} is not a card number: {!r}".format(first + i, values[i]))
+      nums.append(int(value))
+
+    cipher = _worker["cipher"]
+    tokens = cipher.decrypt_batch(nums) if decrypt else cipher.encrypt_batch(nums)
+
+    for i, token in zip(filled, tokens):
+      token = "%016d" % token
+      if fmt == "csv":
+        rows[i][column] = token
+      else:
+        rows[i][column] = int(token) if isinstance(values[i], (int, long)) else token
+
+  if fmt == "csv":
+    return rows
+
+  return [json.dumps(row) + "\n" for row in rows]
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description="Tokenize card number columns of CSV or NDJSON.")
+  parser.add_argument("--key", required=True, help="16 url-safe base64-encoded bytes")
+  parser.add_argument("--columns", required=True, help="comma separated names of the columns")
+  parser.add_argument("--format", choices=FORMATS, default="csv")
+  parser.add_argument("--decrypt", action="store_true", help="detokenize instead")
+  parser.add_argument("--workers", type=int, default=None, help="defaults to the number of CPUs")
+  parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+  parser.add_argument("--max-pending", type=int, default=None,
+                      help="batches in flight, defaults to {} per worker".format(PENDING_PER_WORKER))
+  parser.add_argument("--rounds", type=int, default=10)
+  parser.add_argument("--quiet", action="store_true", help="do not report progress")
+  parser.add_argument("input", nargs="?", type=argparse.FileType("rb"), default=sys.stdin)
+  parser.add_argument("output", nargs="?", type=argparse.FileType("wb"), default=sys.stdout)
+  args = parser.parse_args(argv)
+
+  tokenize_stream(args.input, args.output, args.key, args.columns.split(","),
+                  fmt=args.format, decrypt=args.decrypt, workers=args.workers,
+                  batch_size=args.batch_size, max_pending=args.max_pending,
+                  rounds=args.rounds, progress=None if args.quiet else sys.stderr)
+
+
+if __name__ == "__main__":
+  main()
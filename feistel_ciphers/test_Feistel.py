@@ -1,8 +1,20 @@
-from feistel_ciphers.Feistel import Feistel, LengthPreservingCipher, CreditCardFeistel
+from feistel_ciphers.Feistel import Feistel, MyFeistel, LengthPreservingCipher, MAX_CC_NUM
+from feistel_ciphers.CreditCard import CreditCardFeistel, RadixCreditCardFeistel
 import pytest
 import base64
 import os
 import random as r
+import io
+import json
+
+import numpy as np
+
+from feistel_ciphers.FormatPreserving import FormatSpec, FormatPreservingCipher
+from feistel_ciphers import RecordFile, Tokenize
+
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives.ciphers import Cipher, modes
+from cryptography.hazmat.primitives.ciphers.algorithms import AES
 
 
 class TestMyFeistel:
@@ -78,6 +90,22 @@ class TestMyFeistel:
 
       prvs.add(prv)
 
+  def test_prf_cbc(self):
+    key = base64.urlsafe_b64encode(os.urandom(16))
+    feistel = MyFeistel(key, 3)
+
+    # The cached ECB contexts compute the same AES-CBC PRF as a fresh
+    # CBC encryptor per call, for single and multiple blocks.
+    for round_key in feistel._round_keys:
+      for l in (0, 1, 6, 15, 16, 17, 40):
+        data = os.urandom(l)
+        padded = (16 - l % 16) * '\0' + data
+        encryptor = Cipher(AES(round_key), modes.CBC('\0' * 16),
+                           backend=default_backend()).encryptor()
+        assert feistel._prf(round_key, data) == encryptor.update(padded) + encryptor.finalize()
+
+    assert len(feistel._prf_contexts) == 3
+
   def test_Functionality(self):
     key = base64.urlsafe_b64encode(os.urandom(16))
     feistel = MyFeistel(key, 10)
@@ -89,6 +117,45 @@ class TestMyFeistel:
       assert len(ctx) == len(msg)
       assert feistel.decrypt(ctx) == msg
 
+  def test_rounds_in_place(self):
+    key = base64.urlsafe_b64encode(os.urandom(16))
+
+    # The in place engine matches the rounds applied one after the other.
+    for rounds in (1, 2, 3, 10):
+      feistel = MyFeistel(key, rounds)
+
+      for i in xrange(0, 40, 2):
+        msg = os.urandom(i)
+        ctx = reduce(lambda d, j: feistel._feistel_round_enc(j, d), range(rounds), bytearray(msg))
+        assert feistel.encrypt(msg) == ctx
+
+        ptx = reduce(lambda d, j: feistel._feistel_round_dec(j, d), range(rounds - 1, -1, -1), ctx)
+        assert feistel.decrypt(bytes(ctx)) == ptx == msg
+
+  def test_batch(self):
+    key = base64.urlsafe_b64encode(os.urandom(16))
+
+    for rounds in (1, 2, 10):
+      feistel = MyFeistel(key, rounds)
+
+      # Halves whose PRF input is one block, and several blocks.
+      for length in (0, 2, 6, 30, 32, 70):
+        msgs = [os.urandom(length) for _ in xrange(50)]
+
+        ctxs = feistel.encrypt_batch(msgs)
+        assert ctxs == [feistel.encrypt(msg) for msg in msgs]
+        assert feistel.decrypt_batch(ctxs) == msgs
+
+        blocks = np.frombuffer(b''.join(msgs), dtype=np.uint8).reshape(50, length)
+        encrypted = feistel.encrypt_batch(blocks)
+        assert [bytearray(row.tobytes()) for row in encrypted] == ctxs
+        assert (feistel.decrypt_batch(encrypted) == blocks).all()
+
+    assert feistel.encrypt_batch([]) == []
+
+    with pytest.raises(AssertionError):
+      feistel.encrypt_batch([os.urandom(6), os.urandom(4)])
+
   def test_OddLengthMessage(self):
     key = base64.urlsafe_b64encode(os.urandom(16))
 
@@ -154,6 +221,105 @@ class TestLengthPreservingCipher:
       assert len(ctx) == len(msg)
       assert lpc.decrypt(ctx) == msg
 
+  def test_Tables(self, tmpdir):
+    key = base64.urlsafe_b64encode(os.urandom(16))
+    lpc = LengthPreservingCipher(key, 2)
+    msgs = [os.urandom(2) for _ in xrange(50)] + ['\x00\x00', '\xff\xff']
+    ctxs = [lpc.encrypt(msg) for msg in msgs]
+
+    tables = lpc.build_tables()
+    assert tables.dtype == np.uint32
+    assert sorted(tables[0]) == range(2 ** 16)
+    assert [lpc.encrypt(msg) for msg in msgs] == ctxs
+    assert [lpc.decrypt(ctx) for ctx in ctxs] == msgs
+
+    # Saved tables are memory-mapped on load
+    path = str(tmpdir.join('tables.npy'))
+    lpc.save_tables(path)
+    loaded = LengthPreservingCipher(key, 2, tables=path)
+    assert isinstance(loaded._tables, np.memmap)
+    assert [loaded.encrypt(msg) for msg in msgs] == ctxs
+    assert [loaded.decrypt(ctx) for ctx in ctxs] == msgs
+
+    blocks = np.frombuffer(''.join(msgs), dtype=np.uint8).reshape(-1, 2)
+    assert [bytearray(row.tobytes()) for row in loaded.encrypt_batch(blocks)] == ctxs
+    assert (loaded.decrypt_batch(loaded.encrypt_batch(blocks)) == blocks).all()
+
+    with pytest.raises(ValueError):
+      LengthPreservingCipher(base64.urlsafe_b64encode(os.urandom(16)), 2, tables=path)
+
+    with pytest.raises(ValueError):
+      LengthPreservingCipher(key, 4, tables=path)
+
+    with pytest.raises(ValueError):
+      LengthPreservingCipher(key, 4).build_tables()
+
+    # Tables are saved to and loaded from the same path, whatever its name.
+    path = str(tmpdir.join('tables'))
+    lpc.save_tables(path)
+    assert [LengthPreservingCipher(key, 2, tables=path).encrypt(msg) for msg in msgs] == ctxs
+
+
+class TestRecordFile:
+
+  def setup_method(self, method):
+    self.key = base64.urlsafe_b64encode(os.urandom(16))
+    self.records = [os.urandom(12) for _ in xrange(1000)]
+
+  def expected(self):
+    lpc = LengthPreservingCipher(self.key, 6)
+    return [record[:3] + bytes(lpc.encrypt(record[3:9])) + record[9:] for record in self.records]
+
+  def test_Functionality(self, tmpdir):
+    path = str(tmpdir.join('records.bin'))
+    with open(path, 'wb') as f:
+      f.write(''.join(self.records))
+
+    assert RecordFile.encrypt_file(path, self.key, 12, (3, 9), workers=2, chunk_records=64) == 16
+    with open(path, 'rb') as f:
+      assert f.read() == ''.join(self.expected())
+
+    RecordFile.decrypt_file(path, self.key, 12, (3, 9), workers=2, chunk_records=100)
+    with open(path, 'rb') as f:
+      assert f.read() == ''.join(self.records)
+
+    with pytest.raises(ValueError):
+      RecordFile.encrypt_file(path, self.key, 7, (3, 9))
+
+    # An odd field width is refused before any checkpoint is written.
+    checkpoint = str(tmpdir.join('odd.checkpoint'))
+    with pytest.raises(ValueError):
+      RecordFile.encrypt_file(path, self.key, 12, (3, 8), checkpoint=checkpoint)
+    assert not os.path.exists(checkpoint)
+
+  def test_Resume(self, tmpdir):
+    path = str(tmpdir.join('records.bin'))
+    checkpoint = str(tmpdir.join('records.checkpoint'))
+    with open(path, 'wb') as f:
+      f.write(''.join(self.records))
+
+    # A run interrupted after recording chunk 0, with chunk 1 written to
+    # the file but not recorded, and chunk 2 half way through its redo file.
+    RecordFile._resume(path, checkpoint, "12 3 9 64 encrypt", 12, 64)
+    RecordFile._init_worker(path, self.key, 12, (3, 9), 64, checkpoint, None, False)
+    RecordFile._mark_done(checkpoint, RecordFile._process_chunk(0))
+    RecordFile._process_chunk(1)
+    with open(RecordFile._redo_path(checkpoint, 2) + ".tmp", 'wb') as f:
+      f.write('partial')
+    RecordFile._worker["mmap"].close()
+
+    assert RecordFile.encrypt_file(path, self.key, 12, (3, 9), workers=2,
+                                   checkpoint=checkpoint, chunk_records=64) == 14
+    with open(path, 'rb') as f:
+      assert f.read() == ''.join(self.expected())
+    assert not [name for name in os.listdir(str(tmpdir)) if 'redo' in name]
+
+    # Everything is done, and the checkpoint belongs to this run only.
+    assert RecordFile.encrypt_file(path, self.key, 12, (3, 9), checkpoint=checkpoint,
+                                   chunk_records=64) == 0
+    with pytest.raises(ValueError):
+      RecordFile.decrypt_file(path, self.key, 12, (3, 9), checkpoint=checkpoint)
+
 
 class TestCreditCardFeistel:
 
@@ -199,3 +365,170 @@ class TestCreditCardFeistel:
       cipher_num = feistel.encrypt(plain_num)
 
       assert feistel.decrypt(cipher_num) == plain_num
+
+  def test_encrypt_decrypt(self):
+    key = base64.urlsafe_b64encode(os.urandom(16))
+    feistel = CreditCardFeistel(key, 10)
+
+    for _ in xrange(20):
+      plain_num = r.randint(0, MAX_CC_NUM)
+      assert feistel.decrypt(feistel.encrypt(plain_num)) == plain_num
+
+  def test_batch(self):
+    key = base64.urlsafe_b64encode(os.urandom(16))
+
+    for rounds in (1, 10):
+      feistel = CreditCardFeistel(key, rounds)
+      nums = [r.randint(0, MAX_CC_NUM) for _ in xrange(200)] + [0, MAX_CC_NUM]
+
+      ctxs = feistel.encrypt_batch(nums)
+      assert ctxs.dtype == np.uint64
+      assert list(ctxs) == [feistel.encrypt(num) for num in nums]
+      assert list(feistel.decrypt_batch(ctxs)) == nums
+      assert list(feistel.decrypt_batch(ctxs)) == [feistel.decrypt(int(ctx)) for ctx in ctxs]
+
+    assert len(feistel.encrypt_batch([])) == 0
+
+    with pytest.raises(AssertionError):
+      feistel.encrypt_batch([MAX_CC_NUM + 1])
+
+
+class TestRadixCreditCardFeistel:
+
+  def test_encrypt_decrypt(self):
+    key = base64.urlsafe_b64encode(os.urandom(16))
+    feistel = RadixCreditCardFeistel(key, 10)
+
+    for plain_num in [0, 1, MAX_CC_NUM] + [r.randint(0, MAX_CC_NUM) for _ in xrange(50)]:
+      cipher_num = feistel.encrypt(plain_num)
+      assert 0 <= cipher_num <= MAX_CC_NUM
+      assert feistel.decrypt(cipher_num) == plain_num
+
+    # A permutation of the 16 digit numbers
+    nums = range(1000)
+    assert len(set(feistel.encrypt(num) for num in nums)) == len(nums)
+
+    with pytest.raises(AssertionError):
+      feistel.encrypt(MAX_CC_NUM + 1)
+
+  def test_batch(self):
+    key = base64.urlsafe_b64encode(os.urandom(16))
+    feistel = RadixCreditCardFeistel(key, 10)
+    nums = [r.randint(0, MAX_CC_NUM) for _ in xrange(200)] + [0, MAX_CC_NUM]
+
+    ctxs = feistel.encrypt_batch(nums)
+    assert ctxs.dtype == np.uint64
+    assert list(ctxs) == [feistel.encrypt(num) for num in nums]
+    assert list(feistel.decrypt_batch(ctxs)) == nums
+
+
+class TestFormatPreservingCipher:
+
+  def test_FormatSpec(self):
+    spec = FormatSpec('ddd-dd-dddd')
+    assert len(spec) == 11
+    assert spec.size == 10 ** 9
+    assert spec.rank('000-00-0000') == 0
+    assert spec.rank('123-45-6789') == 123456789
+    assert spec.unrank(123456789) == '123-45-6789'
+
+    spec = FormatSpec(['AB', '-', 'xyz'])
+    assert spec.size == 6
+    assert [spec.unrank(i) for i in range(6)] == ['A-x', 'A-y', 'A-z', 'B-x', 'B-y', 'B-z']
+
+    # Escaped placeholders are literals
+    assert FormatSpec('\\d\\Ad').unrank(7) == 'dA7'
+
+    for value in ('123-45-678', '123-45-678a', '123x45-6789'):
+      with pytest.raises(ValueError):
+        FormatSpec('ddd-dd-dddd').rank(value)
+
+  def test_encrypt_decrypt(self):
+    key = base64.urlsafe_b64encode(os.urandom(16))
+
+    for mask in ('ddd-dd-dddd', '(ddd) ddd-dddd', 'DEdd XXXX XXXX', 'd', 'Aa', 'XXXXXXXXXXXXXXXXXXXX'):
+      fpe = FormatPreservingCipher(key, mask)
+
+      # The network covers the format with less than twice its size.
+      assert fpe.spec.size <= 2 ** fpe._bits < 2 * fpe.spec.size or fpe._bits == 2
+
+      for _ in xrange(20):
+        value = fpe.spec.unrank(r.randint(0, fpe.spec.size - 1))
+        ctx = fpe.encrypt(value)
+        assert fpe.spec.rank(ctx) < fpe.spec.size
+        assert fpe.decrypt(ctx) == value
+
+    # A permutation of the format
+    fpe = FormatPreservingCipher(key, 'ddd')
+    assert sorted(fpe.encrypt('%03d' % i) for i in range(1000)) == ['%03d' % i for i in range(1000)]
+
+  def test_batch(self):
+    key = base64.urlsafe_b64encode(os.urandom(16))
+
+    for mask in ('ddd-dd-dddd', 'd', 'XXXXXXXXXXXXXXXXXXXX'):
+      fpe = FormatPreservingCipher(key, mask)
+      values = [fpe.spec.unrank(r.randint(0, fpe.spec.size - 1)) for _ in xrange(100)]
+
+      ctxs = fpe.encrypt_batch(values)
+      assert ctxs == [fpe.encrypt(value) for value in values]
+      assert fpe.decrypt_batch(ctxs) == values
+
+    assert fpe.encrypt_batch([]) == []
+
+
+class TestTokenize:
+
+  def setup_method(self, method):
+    self.key = base64.urlsafe_b64encode(os.urandom(16))
+    self.feistel = CreditCardFeistel(self.key, 10)
+    self.pans = ['%016d' % r.randint(0, MAX_CC_NUM) for _ in xrange(250)]
+
+  def test_csv(self):
+    text = 'name,pan,other\n' + ''.join('row {},{},"a, b"\n'.format(i, pan) for i, pan in enumerate(self.pans))
+    text += 'empty,,x\n'
+    out, progress = io.BytesIO(), io.BytesIO()
+
+    rows = Tokenize.tokenize_stream(io.BytesIO(text), out, self.key, ['pan'], workers=2,
+                                    batch_size=16, max_pending=3, progress=progress)
+    assert rows == 251
+    assert progress.getvalue().startswith('done: 251 rows')
+
+    lines = out.getvalue().splitlines()
+    assert lines[0] == 'name,pan,other'
+    assert lines[1:-1] == ['row {},{:016d},"a, b"'.format(i, self.feistel.encrypt(int(pan)))
+                           for i, pan in enumerate(self.pans)]
+    assert lines[-1] == 'empty,,x'
+
+    back = io.BytesIO()
+    Tokenize.tokenize_stream(io.BytesIO(out.getvalue()), back, self.key, ['pan'], decrypt=True,
+                             workers=2, batch_size=16)
+    assert back.getvalue() == text
+
+    with pytest.raises(ValueError):
+      Tokenize.tokenize_stream(io.BytesIO(text), io.BytesIO(), self.key, ['nope'], workers=1)
+
+    with pytest.raises(ValueError, match="Row 2 is not a card number"):
+      Tokenize.tokenize_stream(io.BytesIO('pan\n1\nabc\n'), io.BytesIO(), self.key, ['pan'], workers=1)
+
+    with pytest.raises(ValueError, match="Row 2 has 1 fields"):
+      Tokenize.tokenize_stream(io.BytesIO('name,pan\na,1\nb\n'), io.BytesIO(), self.key, ['pan'],
+                               workers=1)
+
+  def test_ndjson(self):
+    text = ''.join(json.dumps({'pan': pan, 'n': int(pan), 'i': i}) + '\n' for i, pan in enumerate(self.pans))
+    out = io.BytesIO()
+
+    Tokenize.tokenize_stream(io.BytesIO(text), out, self.key, ['pan', 'n'], fmt='ndjson',
+                             workers=2, batch_size=16)
+
+    rows = [json.loads(line) for line in out.getvalue().splitlines()]
+    assert [row['i'] for row in rows] == range(len(self.pans))
+    assert [row['pan'] for row in rows] == ['%016d' % self.feistel.encrypt(int(pan)) for pan in self.pans]
+    assert [row['n'] for row in rows] == [self.feistel.encrypt(int(pan)) for pan in self.pans]
+
+    # Only the tokenized values change, the rest of a row is kept as it is.
+    out = io.BytesIO()
+    Tokenize.tokenize_stream(io.BytesIO('{"zeta": 1, "pan": "42", "alpha": "x"}\n'), out, self.key,
+                             ['pan'], fmt='ndjson', workers=1)
+    assert out.getvalue() == '{"zeta": 1, "pan": "%016d", "alpha": "x"}\n' % self.feistel.encrypt(42)
+